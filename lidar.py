@@ -2,17 +2,18 @@ from netCDF4 import Dataset,Variable
 import numpy as np
 import time
 import os.path
-import struct
 import glob
 import json
-import matplotlib.pyplot as plt
-import scipy.misc
+import logging
 from collections import OrderedDict
 from lidar_aux import aux_file
-from lidar_raw import lidar_raw,rebuild_raw
+from lidar_raw import lidar_raw,rebuild_raw,read_raw_files,raw_writer,read_profiles,raw_time,raw_watcher,header_schema
 import zipfile
 import re
-import subprocess
+
+# matplotlib and multiprocessing are imported where they are used,
+# so batch processing starts quickly and without a display
+log=logging.getLogger(__name__)
 
 
 class lidar(object):
@@ -63,6 +64,12 @@ l=lidar.lidar_live('/home/h05/frti/public_html/lidar/',from_rawfolder='/data/loc
     _view="nadir"
     maxheight=0
     fltno='XXXX'
+    workers=1
+    persist_bind=False
+    cache_size=256e6 # bytes
+    aux_lazy=True    # Read core netCDF aux columns as they are needed
+    aux_span=False   # ... and only over the lidar's time span
+    _times=None
     
     def __init__(self,data=None,aux='',**kwargs):
         """
@@ -71,14 +78,13 @@ l=lidar.lidar_live('/home/h05/frti/public_html/lidar/',from_rawfolder='/data/loc
             aux:  Auxilliary ( location ) data, as Core netcdf, or "Horace" text file, or HTTP to live aicraft data
             trigger: Point in raw data where laser fired...
         """
-        print(dir(self))
-        print(kwargs)
+        log.debug('lidar(%r,aux=%r,%r)',data,aux,kwargs)
         for k in kwargs:
             if(k in dir(self)):
-                print(k,kwargs[k])
                 self.__dict__[k]=kwargs[k]
-                print(self.ncfolder)
 
+        self.schema=header_schema()     # Raw file headers are parsed against the first one added
+        self.cache=profile_cache(self.cache_size)
         self.aux=aux
         self.ncfolder=os.path.expandvars(self.ncfolder)
         self.rawfolder=os.path.expandvars(self.rawfolder)
@@ -98,7 +104,7 @@ l=lidar.lidar_live('/home/h05/frti/public_html/lidar/',from_rawfolder='/data/loc
                 self.datapath,self.data=self.create(self.rawfolder,filename=self.ncfolder,**kwargs)
                 self.add_raw()
             elif(os.path.isdir(data)):
-                print(data,self.ncfolder,kwargs)
+                log.debug('Creating netCDF in %r from %r',self.ncfolder,data)
                 self.datapath,self.data=self.create(data,filename=self.ncfolder,**kwargs)
                 self.rawfolder=data
                 self.add_raw()
@@ -113,21 +119,13 @@ l=lidar.lidar_live('/home/h05/frti/public_html/lidar/',from_rawfolder='/data/loc
             self.add_raw()
 
         self.variables=self.data.variables
-        try:
-            self.whereblind,=np.where(~self.data.variables["Blind_offset0"][:].mask)
-        except AttributeError:
-            self.whereblind=np.arange(len(self.data.variables['Blind_offset0'][:]))
-        self.bind=np.full(self["Time"].shape,-1,dtype=int)
-        add=0
-        wb=self.whereblind[:]
-        while(-1 in self.bind):
-            wb=wb[(wb+add)<len(self.bind)]
-            wb=wb[self.bind[wb+add]==-1]
-            self.bind[wb+add]=wb
-            add+=1
-        self.profile=[lidar.getprofile(self.get_prof,self,chan=0),
-                      lidar.getprofile(self.get_prof,self,chan=1),
-                      lidar.getprofile(self.get_prof,self,chan=2)]
+        if(self.aux_span and type(aux)==str and aux.endswith(".nc")):
+            self.aux=aux        # Again now the time span is known
+        self._bind=None
+        self.index_blind()
+        self.profile=[lidar.cachedprofile(self.get_prof,self,chan=0),
+                      lidar.cachedprofile(self.get_prof,self,chan=1),
+                      lidar.cachedprofile(self.get_prof,self,chan=2)]
         self.range_correction=self._range_correction
         self.image=[lidar.getprofile(self.make_img,self,chan=0),
                     lidar.getprofile(self.make_img,self,chan=1),
@@ -148,7 +146,7 @@ l=lidar.lidar_live('/home/h05/frti/public_html/lidar/',from_rawfolder='/data/loc
             self._view="zenith"
         else:
             raise ValueError("View should be zenith ( up ) or nadir (down)")
-        print("View set to {}".format(self._view))
+        log.info("View set to {}".format(self._view))
     @property
     def aux(self):
         return self._aux
@@ -158,8 +156,20 @@ l=lidar.lidar_live('/home/h05/frti/public_html/lidar/',from_rawfolder='/data/loc
             for v in aux.columns[1:]:
                 self.__setattr__(v,lidar.getprofile(self.get_aux,self,para=v))
             self._aux=aux
+            self.cache.clear()
         except AttributeError:
-            self.aux=aux_file(aux)
+            # Before the data is open the span isn't known, so only read what is needed
+            lazy=self.aux_lazy or (self.aux_span and 'data' not in self.__dict__)
+            self.aux=aux_file(aux,lazy=lazy,span=self.aux_timespan())
+
+    def aux_timespan(self):
+        """
+        ( first, last ) lidar time to restrict aux data to if aux_span is set
+        and the data is open, otherwise None
+        """
+        if(self.aux_span and 'data' in self.__dict__ and len(self.times)):
+            return (float(self.times[0]),float(self.times[-1]))
+        return None
           
     @property
     def range_correction(self):
@@ -167,10 +177,11 @@ l=lidar.lidar_live('/home/h05/frti/public_html/lidar/',from_rawfolder='/data/loc
     @range_correction.setter
     def range_correction(self,rc):
         try:
-            self.range_corrected=[lidar.getprofile(self.__getattribute__(rc),self,chan=0),
-                                  lidar.getprofile(self.__getattribute__(rc),self,chan=1),
-                                  lidar.getprofile(self.__getattribute__(rc),self,chan=2)]
+            self.range_corrected=[lidar.cachedprofile(self.__getattribute__(rc),self,chan=0),
+                                  lidar.cachedprofile(self.__getattribute__(rc),self,chan=1),
+                                  lidar.cachedprofile(self.__getattribute__(rc),self,chan=2)]
             self._range_correction=rc
+            self.cache.clear()
         except AttributeError:
             pass
           
@@ -182,10 +193,120 @@ l=lidar.lidar_live('/home/h05/frti/public_html/lidar/',from_rawfolder='/data/loc
     @trigger.setter
     def trigger(self,trigger):
         self._trigger=trigger
-        self.distance=np.arange(-trigger,self['rawSignal_0'].shape[0]-trigger)*self.getncattr('RawResolution (m)')
+        self.cache.clear()
+        self.distance=np.arange(-trigger,len(self.dimensions['Range'])-trigger)*self.getncattr('RawResolution (m)')
         self.distance[:trigger]=np.nan
         
     
+    @property
+    def bind(self):
+        """
+        Index of the blind reference for each profile
+        """
+        if(len(self._bind)!=len(self.data.dimensions['Time'])):
+            self.index_blind()
+        return self._bind
+
+    @property
+    def whereblind(self):
+        """
+        Indexes of the profiles that have a blind reference
+        """
+        if(len(self._bind)!=len(self.data.dimensions['Time'])):
+            self.index_blind()
+        return self._whereblind
+
+    def index_blind(self):
+        """
+        Work out the blind reference for each profile, as the last blind 
+        reference at or before it. Only profiles added since the last call are
+        looked at, and the index is read from the 'bind' variable if 
+        it has been saved in the file
+        """
+        ntime=len(self.data.dimensions['Time'])
+        if(self._bind is None):
+            self._bind=np.zeros(0,dtype=int)
+            self._whereblind=np.zeros(0,dtype=int)
+            if('bind' in self.variables):
+                saved=self.variables['bind'][:]
+                nsaved=np.argmax(np.append(np.ma.getmaskarray(saved),True))
+                self._bind=np.asarray(saved[:nsaved],dtype=int)
+                self._whereblind=np.unique(self._bind)
+        start=len(self._bind)
+        if(start<ntime):
+            wb,=np.where(~np.ma.getmaskarray(self.data.variables['Blind_offset0'][start:]))
+            self._whereblind=np.append(self._whereblind,wb+start)
+            ind=np.searchsorted(self._whereblind,np.arange(start,ntime),side='right')-1
+            self._bind=np.append(self._bind,self._whereblind[np.maximum(ind,0)])
+            if(self.persist_bind):
+                self.save_bind(start)
+        return self._bind
+
+    @property
+    def times(self):
+        """
+        Time of each profile, read from the file once and 
+        extended when profiles are added. Read only
+        """
+        if(self._times is None or len(self._times)!=len(self.data.dimensions['Time'])):
+            self.index_times()
+        return self._times
+
+    def index_times(self):
+        """
+        Read the times of any profiles added since the last call
+        """
+        ntime=len(self.data.dimensions['Time'])
+        if(self._times is None or len(self._times)>ntime):
+            self._times=np.zeros(0)
+        start=len(self._times)
+        t=np.ma.filled(self.data.variables['Time'][start:ntime].astype(float),np.nan)
+        self._times=np.append(self._times,t)
+        self._times.setflags(write=False)
+        return self._times
+
+    def select(self,t0=None,t1=None):
+        """
+        Slice of the profiles with t0 <= Time < t1 ( None for no limit ), 
+        found by bisection of the ( increasing ) times
+        """
+        t=self.times
+        i0=0 if t0 is None else int(np.searchsorted(t,t0,side='left'))
+        i1=len(t) if t1 is None else int(np.searchsorted(t,t1,side='left'))
+        return slice(i0,max(i0,i1))
+
+    def nearest(self,t):
+        """
+        Index of the profile nearest in time to t ( or an array of times )
+        """
+        times=self.times
+        i=np.clip(np.searchsorted(times,t),1,max(len(times)-1,1))
+        i=np.where(np.abs(t-times[i-1])<=np.abs(times[np.minimum(i,len(times)-1)]-t),i-1,i)
+        return i if np.ndim(i) else int(i)
+
+    def previous(self,t):
+        """
+        Index of the last profile at or before t ( or an array of times ), -1 if none
+        """
+        i=np.searchsorted(self.times,t,side='right')-1
+        return i if np.ndim(i) else int(i)
+
+    def save_bind(self,start=0):
+        """
+        Save the blind reference index from profile start on in the netCDF file, 
+        so it doesn't need working out when the file is reopened. 
+        If the file is read only it isn't saved
+        """
+        try:
+            if('bind' not in self.variables):
+                b=self.data.createVariable('bind','i4',('Time',))
+                b.setncattr("long_name","index of blind reference for profile")
+                start=0
+            self.variables['bind'][start:len(self._bind)]=self._bind[start:]
+        except RuntimeError:
+            log.warning("Can't save the blind reference index, the file is read only")
+            self.persist_bind=False
+
     def get_raw_indexes(self):
         b=self.whereblind
         for i in range(len(b)):            
@@ -194,88 +315,6 @@ l=lidar.lidar_live('/home/h05/frti/public_html/lidar/',from_rawfolder='/data/loc
             except IndexError:
                 yield (b[i],len(self.data.variables["Time"]))
             
-    def rebuild_raw(self,folder=''):
-        formats={'Altitude (m)':'{:.6f}','Longitude (deg)':'{:.6f}','Latitude (deg)':'{:.6f}',
-                 'Pressure (hPa)':'{:.1f}','Temperature (degC)':'{:.1f}','Humidity (%)':'{:.1f}',
-                 'AngleAzimuth':'{:.1f}','AngleZenith':'{:.1f}','AnglesNB AA':'{:.0f}',
-                 'AnglesNB ZA':'{:.0f}','NumberOfShot':'{:.0f}','Wave length (nm)':'{:.0f}',
-                 'PRF (Hz)':'{:.0f}','Port':'{:.0f}','LineSeparator':'{:.0f}',
-                 'DecimalSeparator':'{:.0f}','NbOfProfilesPerFile':'{:.0f}','DataCodage':'{:.0f}',
-                 'WritingPosition (byte)':'{:.0f}','NumberOfSignal':'{:.0f}',
-                 'HeaderSize':'{:.0f}','ID ALS':'{:.0f}'}
-        t=self['Time'][:]
-        basetime=86400*(t[0]//86400)
-        nprof=self.getncattr('NbOfProfilesPerFile')
-        variables=[u'Altitude (m)', u'Longitude (deg)', u'Latitude (deg)', u'Pressure (hPa)', u'Temperature (degC)', u'AngleAzimuth', u'AngleZenith']
-        for start,stop in self.get_raw_indexes():
-            filename=time.strftime("_%Y-%m-%d_%H-%M-%S",time.gmtime(t[start]))+time.strftime("_%H-%M-%S.raw",time.gmtime(t[stop-1]))
-            filename=os.path.join(folder,filename)
-            with open(filename,"wb") as f:
-                try:
-                    nwrite=self.getncattr("WritingPosition (byte)")
-                except AttributeError:
-                    nwrite=-1
-                f.write("[ConfigSoftware]\r\n")
-                for att in self.ncattrs():
-                    line=att+"="
-                    try:
-                        form=formats[att]
-                    except KeyError:
-                        form="{:.9f}"
-                    data=self.getncattr(att)
-                    if(att=='NbOfProfilesPerFile'):
-                        data=(stop-start)
-                    if(att=='DateRun'):
-                        data=time.strftime('%Y-%m-%d',time.gmtime(t[start]))
-                    if(str(data)==data):
-                        line+=str(data)
-                    else:
-                        try:
-                            line+="\t".join([form.format(d) for d in data])
-                        except TypeError:
-                            line+=form.format(data)
-                    line+="\r\n"
-                    line=(line.replace('deg',u'\xb0')).encode("latin-1")
-                    f.write(line)
-                    if(att=="VARIABLES"):
-                        for v in variables:
-                            if(v in formats):
-                                form=formats[v].replace("{:","%").replace("}","")
-                            else:
-                                form="%.9f"
-                            f.write((v.replace('deg',u'\xb0')).encode("latin-1")+"=")
-                            try:
-                                self.variables[v][start:stop].tofile(f,sep="\t",format=form)
-                            except NotImplementedError:
-                                self.variables[v][start].tofile(f,sep="\t",format=form)
-                            f.write("\r\n")
-                        
-                for sect,prefix in [("InfoBlindRef","Blind_"),("infoRaw","Raw_")]:
-                    f.write("["+sect+"]\r\n")
-                    for v in self.variables:
-                        if(v.startswith(prefix)):
-                            line=v.replace(prefix,"")
-                            if(line in formats):
-                                form=formats[line]
-                            else:
-                                form="{:.9f}"
-                            line+="="+form.format(self.variables[v][start])+"\r\n"
-                            f.write(line)
-                if(nwrite>0):
-                    f.seek(nwrite)
-                dim1=self.variables['rawSignal_0'].shape[0]
-                f.write(self.write_dims((2,dim1)))
-                self.variables['rawBlind_0'][:,start].astype(">i4").tofile(f,"")
-                self.variables['rawBlind_1'][:,start].astype(">i4").tofile(f,"")
-                for tx in range(start,stop):
-                    f.write(self.write_time(t[tx]))
-                    f.write(self.write_dims((4,dim1)))
-                    for var in ['rawSignal_0','rawSignal_1','rawPhoton_0','rawPhoton_1']:
-                        self.variables[var][:,tx].astype(">i4").tofile(f,"")
-                
-                    
-
-
     def merge_aux(self,aux=None):
         if(aux):
             self.aux=aux
@@ -285,19 +324,14 @@ l=lidar.lidar_live('/home/h05/frti/public_html/lidar/',from_rawfolder='/data/loc
               ('Longitude (deg)','LON_GIN'),
               ('Latitude (deg)','LAT_GIN'),
               ('Pressure (hPa)','PALT_RVS') ]
+        values=self.aux.get_many(self.times,[j for k,j in keys])
         for k,j in keys:
-            ans=self.__getattribute__(j)[:]
+            ans=values[j]
             if(j=='PALT_RVS'):
                 ans=heightpress(ans)
             self.data.variables[k][:]=ans
            
 
-    def write_dims(self,dims):
-        return struct.pack('>II',*dims) 
-                   
-    def write_time(self,t):
-        return time.strftime('%H-%M-%S',time.gmtime(t))           
-
     def __getattr__(self,att):
         try:
             return super.__getattr__(self,att)
@@ -307,7 +341,10 @@ l=lidar.lidar_live('/home/h05/frti/public_html/lidar/',from_rawfolder='/data/loc
             except AttributeError:
                 return self.variables[att]
         
-    def make_curtain(self,n,chan=0,heights=['ALT_GIN','Altitude (m)','PALT_RVS','Pressure (hPa)']):
+    def get_heights(self,n,heights=['ALT_GIN','Altitude (m)','PALT_RVS','Pressure (hPa)']):
+        """
+        Height of profile(s) n in range gates, from the first of heights available
+        """
         hx=None
         for height in heights:
             if(height in dir(self)):
@@ -319,132 +356,263 @@ l=lidar.lidar_live('/home/h05/frti/public_html/lidar/',from_rawfolder='/data/loc
             if(height in self.variables):
                 hx=self.variables[height][n]
                 break
-        if hx==None:
+        if hx is None:
             raise AttributeError('No height data found')
-        
-            
-        w=self['Raw_NumberOfSignal'][self.bind[n]]/self.getncattr('PRF (Hz)')
-        h=hx/1.5
+        return np.ma.filled(np.atleast_1d(hx),np.nan)/1.5
+
+    def curtain_levels(self,h):
+        """
+        Number of height levels in a curtain for heights h ( in range gates )
+        """
         maxheight=self.maxheight
         if(self.view=="nadir"):
             if(maxheight==0):
                 maxheight=np.nanmax(h)
             if(maxheight!=maxheight):
-                print(Warning("Invalid height - NaN"))
+                log.warning("Invalid height - NaN")
                 maxheight=0
         elif(self.view=="zenith"):
             if(maxheight==0):
                 maxheight=10000
-        mxh=maxheight
+        mxh=int(maxheight)
         if(mxh<1):
             mxh=1
-        #im=np.zeros((mxh,self.nprof))
-        rc=self.range_corrected[chan][n][:] # [self.trigger:,:]
+        return mxh
+
+    def make_curtain(self,n,chan=0,heights=['ALT_GIN','Altitude (m)','PALT_RVS','Pressure (hPa)'],levels=None,dtype=float,out=None,gates=None,step=1,cached=True):
+        """
+        Range corrected profile(s) n on a height grid from the ground up ( 1.5m levels ),
+        as dtype, written into out if given. The number of levels is worked out
+        from the heights of the profiles unless given. Only the range gates 
+        that reach the grid are read, or gates ( range corrected gates ) if given. 
+        With step>1 every step'th gate is used, on levels step*1.5m apart.
+        If not cached the profiles are read without going through the profile 
+        cache, for profiles that are only read once
+        """
+        h=self.get_heights(n,heights)
+        if(levels is None):
+            levels=self.curtain_levels(h)
+        if(gates is None):
+            gates=curtain_gates(h,levels,self.view)
+        start,stop,s=gates.indices(len(self.distance)-self.trigger)
+        if(cached):
+            rc=self.range_corrected[chan].window(slice(start,stop),step)[n]
+        else:
+            rc=self.range_corrected[chan].funct(n,chan=chan,gates=slice(start,stop),step=step,cached=False)
 
         if(len(rc.shape)<2):
            rc=rc.reshape(rc.shape+(1,))
-        
-        im=np.full((mxh,rc.shape[1]),np.nan)
-        
-        for prof in range(rc.shape[1]):
-            h1=h[prof]
-            if(h1==h1):  # Check if NaN
-                h1=int(h1)
-                if(h1>0):
-                    if(self.view=="nadir"):
-                        im[mxh-h1:,prof]=rc[:h1,prof]
-                    else:
-                        im[:mxh-h1,prof]=rc[mxh-h1:0:-1,prof]
-        return im[::-1,:]
-
-    def make_img(self,n,chan=0,heights='ALT_GIN',vs='Time',maxheight=0,reduction=10):
+        if(step>1):
+            h=h/step
+            levels=-(-levels//step)
+        return register_curtain(rc,h,levels,view=self.view,dtype=dtype,out=out,first=start//step)
+
+    def make_img(self,n,chan=0,heights=['ALT_GIN','Altitude (m)','PALT_RVS','Pressure (hPa)'],vs='Time',maxheight=0,reduction=10,gates=None,step=1,x0=None,ncols=None):
+        """
+        Image of profile(s) n, with reduction range gates averaged together 
+        ( including any part block at the end ) and each profile drawn across the
+        columns ( 1 per second of vs ) it was measured over. Later profiles
+        are drawn over earlier ones, and anywhere without data is -1000.
+        Only the range gates down to the ground are read, or gates ( range 
+        corrected gates, widened to whole blocks ) if given. With step>1 
+        the blocks are averages of every step'th gate. The columns start at x0 
+        and there are ncols of them, by default from the first profile to the last
+        """
+        if(isinstance(heights,str)):
+            heights=[heights]
         try:
-            h=self.__getattribute__(heights)[n]
-            w=self['Raw_NumberOfSignal'][self.bind[n]]/self.getncattr('PRF (Hz)')
+            h=self.get_heights(n,heights)
         except AttributeError:
             raise AttributeError('No height data')
-        h/=1.5
+        bind=np.atleast_1d(self.bind[n])
+        refs,inv=np.unique(bind,return_inverse=True)
+        w=(np.atleast_1d(self['Raw_NumberOfSignal'][refs])/self.getncattr('PRF (Hz)'))[inv].astype(int)
         if(maxheight==0):
             maxheight=np.nanmax(h)
         if(maxheight!=maxheight):
-            print(Warning("Invalid height - NaN"))
+            log.warning("Invalid height - NaN")
             maxheight=0
-        mxh=maxheight/reduction
+        mxh=int(maxheight/reduction)
         if(mxh<1):
             mxh=1
-        #im=np.zeros((mxh,self.nprof))
-        rc=self.range_corrected[chan][n][self.trigger:,:]
-        x=self[vs][n]
+        hb=h/reduction
+        h1=np.where(np.isfinite(hb),hb,0).astype(int)
+        h1[h1<=0]=1
+        if(gates is None):
+            gates=slice(0,reduction*np.max(h1))
+        start,stop,s=gates.indices(len(self.distance)-self.trigger)
+        first=start//reduction
+        rc=np.ma.getdata(self.range_corrected[chan].window(slice(first*reduction,stop),step)[n])
+        x=np.atleast_1d(self[vs][n])
         if(len(rc.shape)<2):
            rc=rc.reshape(rc.shape+(1,))
         
-        x1=np.min(x)
-        im=np.full((mxh,(np.max(x)-x1)+1),-1000)
-        
-        for prof in range(rc.shape[1]):
-            h1=(h[prof]/reduction)
-            if(h1==h1):  # Check if NaN
-                h1=int(h1)
-                if(h1>0):
-                   im[mxh-h1:,(x[prof]-x1):(x[prof]-x1+w[prof])]=np.mean(rc[:h1*reduction,prof].reshape(h1,reduction,1),axis=1)
-                else:
-                   im[-1,(x[prof]-x1):(x[prof]-x1+w[prof])]=np.mean(rc[:h1,rof])
+        # Average blocks of range gates, from where the ( decimated ) gates read are
+        nr=rc.shape[0]
+        pos=first*reduction+step*np.arange(nr)
+        nblocks=int(pos[-1]//reduction)-first+1
+        edges=np.searchsorted(pos,reduction*(first+np.arange(nblocks)))
+        counts=np.diff(np.append(edges,nr))
+        with np.errstate(invalid='ignore',divide='ignore'):
+            means=np.add.reduceat(rc,np.minimum(edges,nr-1),axis=0)/counts.reshape(-1,1)
+        means[counts==0]=-1000      # No gate in the block when step>reduction
+
+        # Columns each profile is drawn in, profiles with no height are not drawn
+        if(x0 is None):
+            x0=np.min(x)
+        start=np.floor(x-x0).astype(int)
+        if(ncols is None):
+            ncols=np.max(start)+1
+        w[~np.isfinite(hb)]=0
+        prof=np.repeat(np.arange(len(start)),w)
+        cols=np.repeat(start,w)+np.arange(len(prof))-np.repeat(np.cumsum(w)-w,w)
+        inside=(cols>=0)&(cols<ncols)
+        prof=prof[inside]
+        cols=cols[inside]
+
+        # Heights in blocks, profiles at or below a block from the ground just fill the bottom row
+        top=mxh-h1
+
+        # Where profiles overlap the later one is drawn over the earlier ones, 
+        # so draw the columns in layers from the earliest profile
+        order=np.lexsort((-prof,cols))
+        prof=prof[order]
+        cols=cols[order]
+        layer=np.arange(len(cols))-np.searchsorted(cols,cols)
+        rows=np.arange(mxh).reshape(-1,1)
+        im=np.full((mxh,ncols),-1000,dtype=np.float32)
+        for i in range(np.max(np.append(layer,-1)),-1,-1):
+            c=cols[layer==i]
+            p=prof[layer==i]
+            k=rows-top[p]-first
+            sub=im[:,c]
+            np.copyto(sub,means[np.clip(k,0,nblocks-1),p],where=(k>=0)&(k<nblocks))
+            im[:,c]=sub
         return im
  
-    def get_prof(self,n,chan=0):
+    def get_prof(self,n,chan=0,gates=None,step=1):
+        """
+        Calibrated profile(s) n, for range gates gates[::step] if given. 
+        Only those gates are read, the sky background gates before the 
+        trigger are read separately if they aren't included
+        """
         if(chan==2):
-            return self.get_ratio(n)
-        rawsig=self['rawSignal_%i' % chan][:,n]
+            return self.get_ratio(n,gates,step)
+        g=self.gate_slice(gates,step,len(self.dimensions['Range']))
+        s=self.calibrated(n,chan,g)
+        nsky=self.trigger-5
+        if(g.start==0 and g.step==1 and g.stop>=nsky):
+            sky=np.mean(s[:nsky],axis=0)
+        else:
+            sky=np.mean(self.calibrated(n,chan,slice(0,nsky)),axis=0)
+        s-=sky
+        if(np.ndim(self.bind[n])==0):
+            s=s[:,0]
+        return s
+
+    def gate_slice(self,gates,step,ngates,offset=0):
+        """
+        gates ( a slice, None for all ) of ngates range gates with every 
+        step'th one, as a slice of raw range gates starting at offset
+        """
+        if(gates is None):
+            gates=slice(None)
+        start,stop,k=gates.indices(ngates)
+        return slice(start+offset,max(start,stop)+offset,k*step)
+
+    def calibrated(self,n,chan,gates):
+        """
+        Profile(s) n for range gates gates, calibrated for gain, number 
+        of signals and blind reference, as ( Range, profiles ). The profiles are 
+        grouped by blind reference so the gains and blind profile are read 
+        once for each group 
+        """
+        rawsig=self.get_raw('rawSignal_%i' % chan,n,gates)
         toobig= rawsig==1310720
-        rawsig=rawsig.astype(float)
-        rawsig[toobig]=np.nan          #  Maximum range - flatline
-        s=self['Raw_gain%i' % chan][self.bind[n]]*rawsig/self['Raw_NumberOfSignal'][self.bind[n]]
-        blind=self['Blind_gain%i' % chan][self.bind[n]]*self['rawBlind_%i' % chan][:,self.bind[n]]/self['Blind_NumberOfSignal'][self.bind[n]]
-        s-=blind
-        sky=np.mean(s[:self.trigger-5],axis=0)
-        s=(s-sky)
+        s=rawsig.astype(float)
+        s[toobig]=np.nan          #  Maximum range - flatline
+        if(len(s.shape)<2):
+            s=s.reshape(s.shape+(1,))
+        bind=np.atleast_1d(self.bind[n])
+        refs=np.unique(bind)
+        gain=np.atleast_1d(self['Raw_gain%i' % chan][refs])
+        nsig=np.atleast_1d(self['Raw_NumberOfSignal'][refs])
+        blind=np.atleast_1d(self['Blind_gain%i' % chan][refs])*self.get_raw('rawBlind_%i' % chan,refs,gates)/np.atleast_1d(self['Blind_NumberOfSignal'][refs])
+        edges=np.concatenate(([0],np.flatnonzero(np.diff(bind))+1,[len(bind)]))
+        for a,b in zip(edges[:-1],edges[1:]):
+            j=np.searchsorted(refs,bind[a])
+            prof=s[:,a:b]
+            prof*=gain[j]
+            prof/=nsig[j]
+            prof-=blind[:,j:j+1]
         return s
 
-    def get_ratio(self,n):
-        return self.get_prof(n,chan=1)/self.get_prof(n,chan=0)       
+    def calibrate(self,chan=0,block=1000,start=0,stop=None):
+        """
+        Generator of (slice, calibrated profiles) for the flight, 
+        block profiles at a time, to keep memory use bounded
+        """
+        if(stop is None):
+            stop=len(self.data.dimensions['Time'])
+        for i in range(start,stop,block):
+            n=slice(i,min(i+block,stop))
+            yield n,self.get_prof(n,chan=chan)
+
+    def get_raw(self,var,n,gates=slice(None)):
+        """
+        Raw data for profile(s) n, range gates gates, as ( Range, ... ) 
+        whichever way round the variable is stored
+        """
+        return read_profiles(self[var],n,gates)
 
+    def get_ratio(self,n,gates=None,step=1):
+        return self.profile[1].window(gates,step)[n]/self.profile[0].window(gates,step)[n]
 
+    def rc_profiles(self,n,chan,gates,step,cached=True):
+        """
+        Profile(s) n and distances for range gates gates[::step] after the trigger,
+        read through the profile cache if cached
+        """
+        g=self.gate_slice(gates,step,len(self.distance)-self.trigger,self.trigger)
+        if(not(cached)):
+            s=self.get_prof(n,chan=chan,gates=g)
+        elif(gates is None and step==1):
+            s=self.profile[chan][n][g]
+        else:
+            s=self.profile[chan].window(g)[n]
+        d=self.distance[g]
+        if(len(s.shape)>1):
+            d=d.reshape(d.shape+(1,))
+        return s,d
 
-    def get_rc(self,n,chan=0):
-        s=self.get_prof(n,chan=chan)
+    def get_rc(self,n,chan=0,gates=None,step=1,cached=True):
+        s,d=self.rc_profiles(n,chan,gates,step,cached)
         if(chan==2):
-            return s[self.trigger:]
-        if(len(s.shape)>1):
-            d=self.distance.reshape(self.distance.shape+(1,))
-        else:
-            d=self.distance
-        return (s*d**2)[self.trigger:]
+            return s
+        return s*d**2
 
-    def get_rc_corr(self,n,chan=0):
-        s=self.get_prof(n,chan=chan)
+    def get_rc_corr(self,n,chan=0,gates=None,step=1,cached=True):
+        s,d=self.rc_profiles(n,chan,gates,step,cached)
         if(chan==2):
-            return s[self.trigger:]
-        if(len(s.shape)>1):
-            d=self.distance.reshape(self.distance.shape+(1,))
-        else:
-            d=self.distance
-        return (s*(self.rc_div/2.0+d)**2)[self.trigger:]
+            return s
+        return s*(self.rc_div/2.0+d)**2
 
 
     def get_aux(self,n,para='PALT_RVS'):
-        return self.aux.get_values(self['Time'][n],para=para)
+        return self.aux.get_values(self.times,para=para,n=n)
 
 
     def get_img(self,n,chan=0):
         rc=self.get_rc(n,chan=chan)
         
         
-    def make_jpg(self,chan,filename='',heights=[],maxheight=0,**kwargs):
-        im=self.make_img(chan,heights=heights,maxheight=maxheight)
+    def make_jpg(self,chan,filename='',heights=['ALT_GIN','Altitude (m)','PALT_RVS','Pressure (hPa)'],maxheight=0,**kwargs):
+        im=self.make_img(slice(None),chan=chan,heights=heights,maxheight=maxheight)
         if not(filename) or os.path.isdir(filename):
             fn=('lidar_%10.10i.jpg') % self.times[0]
             filename=os.path.join(filename,fn)
-        plt.imsave(filename,im,**kwargs)
+        import matplotlib.image
+        matplotlib.image.imsave(filename,im,**kwargs)
         return filename
         
     def __getitem__(self,item):
@@ -459,6 +627,34 @@ l=lidar.lidar_live('/home/h05/frti/public_html/lidar/',from_rawfolder='/data/loc
             return self.funct(n,**self.kwargs)
         def __len__(self):
             return len(self.data['Time'])
+        def window(self,gates=None,step=1):
+            """
+            The same profiles for range gates gates[::step] only
+            """
+            if(gates is None and step==1):
+                return self
+            kwargs=dict(self.kwargs)
+            kwargs.update(gates=gates,step=step)
+            return self.__class__(self.funct,self.data,**kwargs)
+        def sel(self,t0=None,t1=None):
+            """
+            Profiles with t0 <= Time < t1, see lidar.select
+            """
+            return self[self.data.select(t0,t1)]
+
+    class cachedprofile(getprofile):
+        """
+        getprofile that keeps the results in the lidar's profile cache,
+        for single profiles and slices
+        """
+        def __getitem__(self,n):
+            try:
+                kwargs=[(k,(v.start,v.stop,v.step) if isinstance(v,slice) else v) for k,v in sorted(self.kwargs.items())]
+                key=(self.funct.__name__,tuple(kwargs),block_key(n,len(self)),
+                     self.data.trigger,self.data.range_correction,self.data.rc_div)
+            except TypeError:
+                return self.funct(n,**self.kwargs)
+            return self.data.cache.get(key,self.funct,n,**self.kwargs)
 
 
     def create(self,folder,**kwargs):
@@ -469,8 +665,7 @@ l=lidar.lidar_live('/home/h05/frti/public_html/lidar/',from_rawfolder='/data/loc
         except AttributeError:
             fs=glob.glob(os.path.join(folder,'*.raw'))
         try:
-            l=lidar_raw(sorted(fs)[0],zipfile=zfile)
-            print(l)
+            l=lidar_raw(sorted(fs)[0],zipfile=zfile,schema=self.schema)
             ncpath,nc=l.createrawNetCDF(fltno=self.fltno,**kwargs)
             l.addData(nc)
             return ncpath,nc
@@ -478,8 +673,14 @@ l=lidar.lidar_live('/home/h05/frti/public_html/lidar/',from_rawfolder='/data/loc
             raise IOError("No Raw data in "+folder)
         
 
-    def add_raw(self,folder="",files=[]):
+    def add_raw(self,folder="",files=[],workers=None):
+        """
+        Add any raw files newer than the current data,
+        decoding them with workers processes
+        """
         zfile=None
+        if(workers is None):
+            workers=self.workers
         if(folder):
             self.rawfolder=folder
         if(not(files)):
@@ -488,38 +689,74 @@ l=lidar.lidar_live('/home/h05/frti/public_html/lidar/',from_rawfolder='/data/loc
                 zfile=self.rawfolder
             except AttributeError:
                 files=glob.glob(os.path.join(self.rawfolder,'*.raw'))
-        last=self['Time'][:][-1]  # Don't know why I need [:] ...
-        added=False
+        last=self.times[-1]
+        new=[]
         for f in sorted(files):
-            t=time.mktime(time.strptime(f[-32:-13]+"-UTC","%Y-%m-%d_%H-%M-%S-%Z"))
-            if(t>last):     
-                lidar_raw(f,zfile).addData(self)
-                added=True
-        return added
+            if(raw_time(f)>last):     
+                new.append(f)
+        with raw_writer(self) as writer:
+            for l in read_raw_files(new,zfile,workers=workers,schema=self.schema):
+                writer.add(l)
+        return len(new)>0
                  
-    def rebuild_raw(self,folder=''):
-        rebuild_raw(self,folder)        
+    def rebuild_raw(self,folder='',workers=None):
+        """
+        Write the data out as leosphere style raw files, 
+        by workers processes ( lidar.workers by default )
+        """
+        if(workers is None):
+            workers=self.workers
+        rebuild_raw(self,folder,workers=workers)        
+
 
+    def curtain_blocks(self,blocks,levels,workers=None):
+        """
+        Generator of the curtains for each of the blocks ( slices ), for channel 0 then 1. 
+        With workers>1 they are worked out by a pool of processes reading the netCDF file, 
+        but are still returned in order. The profiles are only read once, so not cached
+        """
+        if(workers is None):
+            workers=self.workers
+        if(workers<=1):
+            for n in blocks:
+                for chan in range(2):
+                    yield self.make_curtain(n,chan=chan,levels=levels,cached=False)
+            return
+        h=self.get_heights(slice(None))
+        settings={'view':self.view,'trigger':self.trigger,'rc_div':self.rc_div,
+                  'range_correction':self.range_correction}
+        try:
+            self.data.sync()
+        except RuntimeError:
+            pass        # Read only
+        tasks=[(self.data.filepath(),settings,n,chan,h[n],levels) for n in blocks for chan in range(2)]
+        import multiprocessing
+        pool=multiprocessing.Pool(workers)
+        try:
+            for curtain in pool.imap(_curtain_block,tasks):
+                yield curtain
+        finally:
+            pool.terminate()
+            pool.join()
 
-    def createCurtainNC(self,filename='',revision=0):
-        """ Opens a raw netcdf file and creates 
-        variables and attibutes.
-        The global attributes are based on the "ConfigSoftware" header info
-        The variables are from InfoBlindRef and infoRaw as well
-        as the raw signal, photon count and blind reference values
+    def createCurtainNC(self,filename='',revision=0,block=1000,workers=None):
+        """ Creates a level 1 netcdf file of the range corrected 
+        curtains for both channels.
+        The flight is processed block profiles at a time and appended 
+        to the file, so memory use depends on the block size not the flight length.
+        The blocks are processed by workers processes ( lidar.workers by default )
         """
-        date=time.strftime('%Y%m%d',time.gmtime(self['Time'][0]))
+        date=time.strftime('%Y%m%d',time.gmtime(float(self.times[0])))
         if(not(filename) or os.path.isdir(filename)):
             fn=('metoffice-lidar_faam_'+date+'_r%1.1i_'+self.fltno+'_level1.nc') % revision
             filename=os.path.join(filename,fn)
         nc=Dataset(filename,"w",clobber=True)
         for att in self.ncattrs():
             nc.setncattr(att,self.getncattr(att))
-        print('Extracting curtains...')
-        curtain=[self.curtain[i][:] for i in range(2)]
-        print('Create dataset...')
+        log.info('Create dataset...')
+        levels=self.curtain_levels(self.get_heights(slice(None)))
         nc.createDimension('Time',None)
-        nc.createDimension('Altitude',curtain[0].shape[0])
+        nc.createDimension('Altitude',levels)
         t=nc.createVariable('Time',float,('Time'))
         t.setncattr("units","seconds since 1970-01-01 00:00:00 +0000")
         t.setncattr("long_name","time of measurement")
@@ -536,32 +773,418 @@ l=lidar.lidar_live('/home/h05/frti/public_html/lidar/',from_rawfolder='/data/loc
         lon.setncattr("units","deg")
         lon.setncattr("long_name","Longitude of measurement")
         lon.setncattr("standard_name","longitude")
-        t[:]=self['Time']
-        lat[:]=self['Latitude (deg)'][:]
-        lon[:]=self['Longitude (deg)'][:]
-        h[:]=np.arange(curtain[0].shape[0],dtype=float)*1.5
+        h[:]=np.arange(levels,dtype=float)*1.5
         v=[nc.createVariable('rangeCorrected_%1.1i' % i,float,('Altitude','Time'),zlib=True) for i in range(2)]
-        v[0][:]=curtain[0]
-        v[1][:]=curtain[1]
+        log.info('Extracting curtains...')
+        ntime=len(self.data.dimensions['Time'])
+        blocks=[slice(i,min(i+block,ntime)) for i in range(0,ntime,block)]
+        for n in blocks:
+            t[n]=self.times[n]
+            lat[n]=self['Latitude (deg)'][n]
+            lon[n]=self['Longitude (deg)'][n]
+        for (n,chan),curtain in zip([(n,chan) for n in blocks for chan in range(2)],self.curtain_blocks(blocks,levels,workers)):
+            v[chan][:,n]=curtain
         
-
         return nc    
         
         
             
 
             
-def create(folder,**kwargs):
+def create(folder,workers=1,**kwargs):
     fs=glob.glob(os.path.join(folder,'*.raw'))
-    first=True
-    for f in sorted(fs):
-        l=lidar_raw(f)
-        if(first):
+    writer=None
+    for l in read_raw_files(sorted(fs),workers=workers):
+        if(writer is None):
             ncpath,nc=l.createrawNetCDF(**kwargs)
-            first=False
-        l.addData(nc)
+            writer=raw_writer(nc)
+        writer.add(l)
+    writer.flush()
     return lidar(nc)
+
+def main(argv=None):
+    """
+    Batch conversion from the command line, eg
+        python lidar.py rawfolder --aux core.nc --ncfolder out --level1
+    Nothing is plotted to a display, so this runs headless
+    """
+    import argparse
+    os.environ.setdefault('MPLBACKEND','Agg')
+    p=argparse.ArgumentParser(description='Convert lidar raw files to netCDF')
+    p.add_argument('data',help='Folder or zip of raw files, or a raw netCDF file')
+    p.add_argument('--aux',default='',help='Core netCDF or Horace file to merge positions from')
+    p.add_argument('--ncfolder',default='',help='Folder for the netCDF files')
+    p.add_argument('--workers',type=int,default=1,help='Number of processes')
+    p.add_argument('--level1',action='store_true',help='Also write the level 1 curtains')
+    p.add_argument('--revision',type=int,default=0)
+    p.add_argument('-v','--verbose',action='store_true')
+    args=p.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    if(args.data.endswith(".nc")):
+        kwargs={'mode':'a'} if args.aux else {}     # Passed on to the Dataset
+    else:
+        kwargs={'ncfolder':args.ncfolder,'workers':args.workers}
+    l=lidar(args.data,aux=args.aux,**kwargs)
+    l.workers=args.workers
+    if(args.aux):
+        l.merge_aux()
+    if(args.level1):
+        l.createCurtainNC(filename=args.ncfolder,revision=args.revision)
+    l.data.close()
+    return 0
+
+def benchmark_layouts(folder,ncfolder='',layouts=None,nread=100):
+    """
+    Compare writing and reading raw netCDF files with different
+    chunking and compression.
+    layouts is a list of keyword dictionaries for createrawNetCDF,
+    returns a list of (layout, write MB/s, mean time to read profile[0][n])
+    """
+    if(layouts is None):
+        layouts=[{'chunk':None},{'chunk':1},{'chunk':16},{'chunk':64},
+                 {'chunk':16,'complevel':1},{'chunk':16,'shuffle':False},
+                 {'chunk':16,'layout':('Time','Range')}]
+    fs=sorted(glob.glob(os.path.join(folder,'*.raw')))
+    schema=header_schema()
+    raws=[lidar_raw(f,schema=schema) for f in fs]
+    nbytes=sum([l.raw.nbytes for l in raws])
+    results=[]
+    for i,layout in enumerate(layouts):
+        filename=os.path.join(ncfolder,'benchmark_%i_raw.nc' % i)
+        t0=time.time()
+        ncpath,nc=raws[0].createrawNetCDF(filename,**layout)
+        with raw_writer(nc) as writer:
+            for l in raws:
+                writer.add(l)
+        nc.close()
+        write=nbytes/1e6/(time.time()-t0)
+        l=lidar(filename,cache_size=0)     # Time the reads, not the cache
+        ns=np.random.randint(0,len(l.profile[0]),nread)
+        t0=time.time()
+        for n in ns:
+            l.profile[0][n]
+        read=(time.time()-t0)/nread
+        l.close()
+        os.remove(filename)
+        log.info('%s write %.1f MB/s read %.2f ms',layout,write,read*1000)
+        results.append((layout,write,read))
+    return results
+    
+def curtain_gates(h,mxh,view="nadir"):
+    """
+    Slice of the range corrected gates that can reach a grid of mxh 
+    heights for profiles at heights h ( in range gates )
+    """
+    if(view=="nadir"):
+        h1=np.where(np.isfinite(h),h,0).astype(int)
+        return slice(0,max(int(np.max(np.append(h1,0))),1))
+    return slice(0,max(int(mxh),1))
+
+def register_curtain(rc,h,mxh,view="nadir",dtype=float,out=None,block=1024,first=0):
+    """
+    Put range corrected profiles rc ( range, profiles ) on to a grid of mxh
+    heights from the ground up, given the height of each profile in range gates h.
+    rc starts at range gate first, gates outside it are left as NaN.
+    The profiles are gathered block profiles at a time to limit the size of the index arrays
+    """
+    rc=np.ma.getdata(rc)
+    nrc,nprof=rc.shape
+    if(out is None):
+        out=np.empty((mxh,nprof),dtype=dtype)
+    out.fill(np.nan)
+    h1=np.where(np.isfinite(h),h,0).astype(int)
+    rows=np.arange(mxh).reshape(-1,1)
+    for a in range(0,nprof,block):
+        b=min(a+block,nprof)
+        if(view=="nadir"):
+            k=h1[a:b]-1-rows
+            valid=(k>=0)
+        else:
+            k=rows+1-h1[a:b]
+            valid=(k>=1)
+        k=k-first
+        valid&=(k>=0)&(k<nrc)&(h1[a:b]>0)
+        np.copyto(out[:,a:b],rc[np.clip(k,0,nrc-1),np.arange(a,b)],where=valid)
+    return out
+
+class lidar_live(lidar):
+    """
+    Lidar data kept up to date from a folder of raw files as they arrive.
+    Only the new profiles are processed on each update, the blind index 
+    and the curtains are extended rather than recalculated
+    """
+    interval=10
     
+    def __init__(self,ncfolder='',from_rawfolder='',heights='',jpg_folder='',vmin=None,vmax=None,cmap=None,**kwargs):
+        """
+        Initialise from
+            ncfolder: Folder for the raw netCDF file
+            from_rawfolder: Folder the raw files are arriving in
+            heights: Auxilliary ( location ) data, as for lidar
+            jpg_folder: Folder for quick look images
+            vmin,vmax,cmap: Colour scaling for the quick look images
+        """
+        # Only start from files whose size has stopped changing, 
+        # the newest may still be being written and is left to the watcher
+        self.watcher=raw_watcher(from_rawfolder)
+        self._settled=self.watcher.poll()
+        while(not(self._settled)):
+            log.info('Waiting for raw files in %s',from_rawfolder)
+            time.sleep(self.interval)
+            self._settled=self.watcher.poll()
+        lidar.__init__(self,from_rawfolder,aux=heights,ncfolder=ncfolder,**kwargs)
+        self.watcher.last=max(self.watcher.last,self.times[-1])
+        self.jpg_folder=jpg_folder
+        self.jpg_kwargs=dict([(k,v) for k,v in [('vmin',vmin),('vmax',vmax),('cmap',cmap)] if v is not None])
+        if(jpg_folder):
+            self.tiles=[quicklook_tiles(self,jpg_folder,chan=chan,**self.jpg_kwargs) for chan in range(2)]
+        self.levels=1
+        self._curtains=[np.full((1,0),np.nan,dtype=np.float32) for chan in range(2)]
+        self.drawn=0
+        self.extend_curtains(0,self.covered())
+        self.running=False
+
+    def add_raw(self,folder="",files=[],workers=None):
+        """
+        Add the raw files given, or when starting those the watcher 
+        has seen are complete, never the whole folder
+        """
+        if(not(files)):
+            files,self._settled=self._settled,[]
+            if(not(files)):
+                return False
+        return lidar.add_raw(self,folder,files,workers)
+
+    @property
+    def curtains(self):
+        """
+        The curtains for both channels so far
+        """
+        return [c[:self.levels,:self.drawn] for c in self._curtains]
+
+    def covered(self):
+        """
+        Number of profiles the aux data covers. Live aux data gives the last
+        position for later times, so those profiles are left until it arrives
+        """
+        ntime=len(self.data.dimensions['Time'])
+        if(not(hasattr(self.aux,'url')) or ntime==0):
+            return ntime
+        if(len(self.aux.times)==0):
+            return 0
+        return int(np.searchsorted(self.times,self.aux.times[-1],side='right'))
+
+    def extend_curtains(self,start,stop):
+        """
+        Add profiles start to stop to the curtains, the storage
+        is grown by doubling so each update only touches the new profiles
+        """
+        if(stop<=start):
+            return
+        n=slice(start,stop)
+        h=self.get_heights(n)
+        self.levels=max(self.levels,self.curtain_levels(h))
+        for chan in range(2):
+            c=self._curtains[chan]
+            if(c.shape[0]<self.levels or c.shape[1]<stop):
+                new=np.full((max(self.levels,c.shape[0]),max(stop,2*c.shape[1])),np.nan,dtype=np.float32)
+                new[:c.shape[0],:start]=c[:,:start]
+                c=self._curtains[chan]=new
+            self.make_curtain(n,chan=chan,levels=self.levels,out=c[:self.levels,start:stop],cached=False)
+        self.drawn=max(self.drawn,stop)
+
+    def update(self):
+        """
+        Add any new raw files, extend the curtains and quick looks over 
+        the profiles the aux data now covers, returns the number of new profiles
+        """
+        ntime=len(self.data.dimensions['Time'])
+        files=self.watcher.poll()
+        if(files):
+            self.add_raw(files=files)
+            self.data.sync()
+        start=self.drawn
+        self.extend_curtains(start,self.covered())
+        if(self.drawn>start and self.jpg_folder):
+            self.write_quicklooks()
+        return len(self.data.dimensions['Time'])-ntime
+
+    def write_quicklooks(self):
+        end=self.times[self.drawn-1]
+        for tiles in self.tiles:
+            tiles.update(end)
+
+    def run(self):
+        """
+        Keep updating every interval seconds until stopped
+        """
+        if(hasattr(self.aux,'url')):
+            self.aux.start()        # Live aux data
+        self.running=True
+        while(self.running):
+            t=time.time()
+            self.update()
+            time.sleep(max(0,self.interval-(time.time()-t)))
+
+    def stop(self):
+        self.running=False
+        if(hasattr(self.aux,'url')):
+            self.aux.stop()
+
+
+class quicklook_tiles(object):
+    """
+    Quick look images of a lidar channel cut into fixed width tiles of tile seconds.
+    Finished tiles are kept on disk, so only the latest ( still growing ) tile is 
+    rendered on each update. An index ( json ) and mosaic page list the tiles
+    """
+    def __init__(self,data,folder,chan=0,tile=600,maxheight=8000,reduction=10,heights=['ALT_GIN','Altitude (m)','PALT_RVS','Pressure (hPa)'],**kwargs):
+        self.data=data
+        self.folder=folder
+        self.chan=chan
+        self.tile=tile
+        self.maxheight=maxheight
+        self.reduction=reduction
+        self.heights=heights
+        self.kwargs=kwargs
+        self.indexfile=os.path.join(folder,'lidar_tiles_%1.1i.json' % chan)
+        self.tiles=OrderedDict()
+        if(os.path.exists(self.indexfile)):
+            with open(self.indexfile) as f:
+                index=json.load(f)
+            if(index['tile']==self.tile):
+                for t in index['tiles']:
+                    self.tiles[t['start']]=t
+
+    def update(self,end=None):
+        """
+        Render any new or unfinished tiles up to time end ( the last profile
+        if None ), returns the list of tiles rendered
+        """
+        t=self.data.times
+        if(end is None):
+            end=t[-1]
+        first=int(t[0]//self.tile)*self.tile
+        rendered=[]
+        for t0 in range(first,int(end)+1,self.tile):
+            if(t0 in self.tiles and self.tiles[t0]['complete']):
+                continue
+            self.tiles[t0]={'start':t0,'file':self.render(t0,t),'complete':bool(end>=t0+self.tile)}
+            rendered.append(t0)
+        if(rendered):
+            self.write_index()
+        return rendered
+
+    def render(self,t0,t):
+        """
+        Render the tile starting at t0 ( t is the lidar Time ). Profiles from 
+        before the tile that are still being drawn at t0 are included
+        """
+        n=self.data.select(t0-self.lookback(),t0+self.tile)
+        img=np.full((int(self.maxheight/self.reduction),self.tile),-1000,dtype=np.float32)
+        if(n.stop>n.start):
+            im=self.data.make_img(n,chan=self.chan,heights=self.heights,
+                                  maxheight=self.maxheight,reduction=self.reduction,
+                                  x0=t0,ncols=self.tile)
+            img[-im.shape[0]:,:]=im[-img.shape[0]:,:]
+        fn='lidar_%1.1i_%10.10i.png' % (self.chan,t0)
+        import matplotlib.image
+        matplotlib.image.imsave(os.path.join(self.folder,fn),img,**self.kwargs)
+        return fn
+
+    def lookback(self):
+        """
+        Longest time ( seconds ) a profile is drawn across
+        """
+        refs=self.data.whereblind
+        nsig=np.ma.filled(np.atleast_1d(self.data['Raw_NumberOfSignal'][refs]).astype(float),0)
+        return int(np.max(np.append(nsig,0))/self.data.getncattr('PRF (Hz)'))+1
+
+    def write_index(self):
+        """
+        Write the tile index, and a page showing the tiles side by side
+        """
+        tiles=list(self.tiles.values())
+        with open(self.indexfile,'w') as f:
+            json.dump({'chan':self.chan,'tile':self.tile,'tiles':tiles},f)
+        with open(self.indexfile.replace('.json','.html'),'w') as f:
+            f.write('<html><body style="white-space:nowrap">\n')
+            for t in tiles:
+                f.write('<img src="{}" title="{}">'.format(t['file'],time.strftime('%H:%M:%S',time.gmtime(t['start']))))
+            f.write('\n</body></html>\n')
+
+
+_curtain_lidars={}
+
+def _curtain_block(args):
+    """
+    Curtain for a block of profiles in a worker process,
+    the heights are passed in as the aux data may not be available
+    """
+    path,settings,n,chan,h,levels=args
+    if(path not in _curtain_lidars):
+        os.environ.setdefault('HDF5_USE_FILE_LOCKING','FALSE')
+        _curtain_lidars[path]=lidar(path)
+    l=_curtain_lidars[path]
+    l._view=settings['view']
+    l.rc_div=settings['rc_div']
+    if(l.range_correction!=settings['range_correction']):
+        l.range_correction=settings['range_correction']
+    if(l.trigger!=settings['trigger']):
+        l.trigger=settings['trigger']
+    g=curtain_gates(h,levels,l.view)
+    return register_curtain(l.range_corrected[chan].funct(n,chan=chan,gates=g,cached=False),h,levels,view=l.view)
+
+class profile_cache(object):
+    """
+    Least recently used cache of profiles, limited to maxbytes of data.
+    Callers get their own copy, so they can change it without changing the cache
+    """
+    def __init__(self,maxbytes=256e6):
+        self.maxbytes=maxbytes
+        self.items=OrderedDict()
+        self.nbytes=0
+        self.hits=0
+        self.misses=0
+
+    def get(self,key,funct,*args,**kwargs):
+        """
+        Cached value for key, or the result of funct(*args,**kwargs)
+        """
+        if(key in self.items):
+            value=self.items.pop(key)
+            self.items[key]=value
+            self.hits+=1
+            return value.copy()
+        self.misses+=1
+        value=funct(*args,**kwargs)
+        nbytes=np.asarray(value).nbytes
+        if(nbytes<=self.maxbytes):
+            self.items[key]=value
+            self.nbytes+=nbytes
+            while(self.nbytes>self.maxbytes):
+                k,v=self.items.popitem(last=False)
+                self.nbytes-=np.asarray(v).nbytes
+            return value.copy()
+        return value
+
+    def clear(self):
+        self.items.clear()
+        self.nbytes=0
+
+def block_key(n,length):
+    """
+    Hashable key for a profile number or slice, 
+    raises TypeError for anything else
+    """
+    if(isinstance(n,slice)):
+        return n.indices(length)
+    if(isinstance(n,(int,np.integer))):
+        if(n<0):
+            n+=length
+        return int(n)
+    raise TypeError("Can only cache single profiles or slices")
+
 def pressheight(press,qnh=1013.25):
     if(qnh==1013.25):
         return (1-(press/1013.25)**0.190284)*44307.69396
@@ -574,5 +1197,6 @@ def heightpress(height,qnh=1013.25):
     else:
         return heightpress(height+pressheight(qnh))
 
-    
 
+if __name__=='__main__':
+    main()
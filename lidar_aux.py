@@ -1,13 +1,9 @@
 import threading
-import multiprocessing
-import urllib2
-import cookielib
 import time
 import numpy as np
 from netCDF4 import Dataset
 import time
 import os.path
-import socket
 import struct
 import json
 
@@ -25,6 +21,17 @@ class aux_file(object):
     initial_data="para=flight_number&para=time_since_midnight&para=utc_time"
     timeout=2
     flt_no='XXXX'
+    interp='previous'
+    transport=None      # Object with get(path) for the live data, HTTP by default
+    interval=1.0        # Seconds between polls
+    max_backoff=8.0     # Longest wait between polls after errors
+    catchup=2.0         # Keep requesting while data is more than this many seconds old
+    max_requests=10     # ... up to this many requests per poll
+    cache_suffix=".bin" # Binary copy of the text file, kept alongside it
+    cache_header=struct.Struct('<8sQdQ')
+    cache_magic=b'HORACE01'
+    lazy=False          # Read core netCDF columns only when they are asked for
+    span=None           # ( start, end ) times to restrict core netCDF data to
     def __init__(self,source='HTTP',path=r"C:\Horace",**kwargs):
         """
         Reads or creates a "Horace" text file for compatibility with IDL lidar code
@@ -34,7 +41,7 @@ class aux_file(object):
         for k in kwargs:
             if(k in dir(self)):
                 self.__dict__[k]=kwargs[k]
-        self.dtype=zip(self.columns,['f8']*len(self.columns))
+        self.dtype=list(zip(self.columns,['f8']*len(self.columns)))
 
         if(source.upper().startswith("HTTP")):
             if(source.upper()=="HTTP"):
@@ -44,7 +51,10 @@ class aux_file(object):
                 self.tank=s[1].replace("/","")
             self.url="http://"+self.tank+self.dataurl
             self.paraurl=self.url+"para="+"&para=".join(self.paras)
+            self.parapath=self.dataurl+"para="+"&para=".join(self.paras)
             self.timeout=2
+            if(self.transport is None):
+                self.transport=http_transport(self.tank,timeout=self.timeout)
             self.initialise()                
             self.filename=os.path.join(path,self.file_prefix+self.date+".dat")
             try:
@@ -65,15 +75,14 @@ class aux_file(object):
 
     def initialise(self):
         try:
-            response = urllib2.urlopen(self.url+self.initial_data,timeout=self.timeout)
-            js=response.read()
+            js=self.transport.get(self.dataurl+self.initial_data)
             if(js):
                 dat=json.loads(js)
                 self.basetime=dat['utc_time'][0]-dat['time_since_midnight'][0]
                 self.flt_no=dat['flight_number'][0]
             else:
                 self.basetime=None
-        except(urllib2.HTTPError):
+        except(IOError):
             self.basetime=None
 
     @property
@@ -101,11 +110,23 @@ class aux_file(object):
 
     @property
     def data(self):
-        return self._data
+        return self._buffer.data
     @data.setter
     def data(self,d):
-        self._data=d
-        self.times=d['Time']+self.basetime
+        self._buffer=aux_buffer(d,self.basetime)
+
+    @property
+    def times(self):
+        return self._buffer.times
+
+    def append(self,d):
+        """
+        Add records to the end of the data
+        """
+        try:
+            self._buffer.append(d)
+        except AttributeError:
+            self.data=d
 
     def start(self):
         self.thread=self.HTTP_thread(self)
@@ -118,36 +139,69 @@ class aux_file(object):
             self.caller=caller
             threading.Thread.__init__(self)
         def run(self):   
+            """
+            Poll every interval seconds ( less the time the poll took ), 
+            backing off up to max_backoff while the server isn't answering
+            """
             self.running=True
+            delay=self.caller.interval
             while self.running:
-                time.sleep(1.0)
-                self.caller.add_latest()
+                start=time.time()
+                try:
+                    self.caller.add_latest()
+                    delay=self.caller.interval
+                except(IOError,ValueError):
+                    delay=min(2*delay,self.caller.max_backoff)
+                time.sleep(max(0,delay-(time.time()-start)))
                       
         
     def add_latest(self):
+        """
+        Get any new data. If it is still more than catchup seconds behind 
+        ( eg after a gap ), the following ranges are requested straight away
+        """
+        for i in range(self.max_requests):
+            if(self.fetch()==0):
+                break
+            if(time.time()-self.times[-1]<=self.catchup):
+                break
+
+    def fetch(self):
+        """
+        Request the data since the last record, returns the number of new records
+        """
         try:
             last=int(self.times[-1]+1)
         except AttributeError:
             last=0
-        #print(self.paraurl+"&frm={:d}".format(last))
-        response = urllib2.urlopen(self.paraurl+"&frm={:d}".format(last),timeout=self.timeout)
-        js=response.read()
+        js=self.transport.get(self.parapath+"&frm={:d}".format(last))
         if(js):
             dat=json.loads(js)
             if(len(dat['time_since_midnight'])):
-                data=np.empty(len(dat['time_since_midnight']),dtype=self.dtype)
-                for c,p in zip(self.columns,self.paras):
-                    data[c]=dat[p]
+                data=np.rec.fromarrays([dat[p] for p in self.paras],dtype=self.dtype).view(np.ndarray)
                 if(self.file_prefix):
+                    cached=self.cache_records() is not None
                     with open(self.filename,"a") as f:
                         np.savetxt(f,data,fmt=self.format)
-                try:
-                    self.data=np.append(self.data,data)
-                except AttributeError:
-                    self.data=data
+                self.append(data)
+                if(self.file_prefix):
+                    if(cached):
+                        self.write_cache(data,append=True)
+                    else:
+                        self.write_cache(self.data)
+                return len(data)
+        return 0
         
 
-    def read_nc(self,path,fill=np.nan,**kwargs):
+    def read_nc(self,path,fill=np.nan,lazy=None,span=None,**kwargs):
+        """
+        Read from a core netCDF, only the records within span if given.
+        If lazy the file is kept open and each column read when first used
+        """
+        if(lazy is None):
+            lazy=self.lazy
+        if(span is None):
+            span=self.span
         data=Dataset(path)
         self.date=data.variables['Time'].units
         try:
@@ -156,33 +210,66 @@ class aux_file(object):
             self.flt_no=os.path.basename(path)[27:31].upper()
                            
         self.filename=os.path.join(self.folder,self.file_prefix+self.date+".dat")
-        d=np.empty(data.variables['Time'].shape,dtype=self.dtype)
-        for c in self.columns:
-            if(len(data.variables[c].shape)>1):
-                try:
-                    d[c]=data.variables[c][:,0].filled(fill)
-                except AttributeError:
-                    d[c]=data.variables[c][:,0]
-                d[c][data.variables[c+"_FLAG"][:,0]>1]=fill
-            else:
-                try:
-                    d[c]=data.variables[c][:].filled(fill)
-                except AttributeError:
-                    d[c]=data.variables[c][:]
-                try:
-                    d[c][data.variables[c+"_FLAG"][:]>1]=fill
-                except KeyError:
-                    pass
-        data.close()
-        self.data=d
-        del data
+        buf=nc_buffer(data,self.columns,self.basetime,span=span,fill=fill)
+        if(lazy):
+            self._buffer=buf
+        else:
+            self.data=buf.data
+            buf.close()
         
-    def get_values(self,times,para='ALT_GIN'):
+    def get_values(self,times,para='ALT_GIN',interp=None,n=slice(None)):
+        """
+        Values of para at times[n], see get_many
+        """
+        return self.get_many(times,[para],interp=interp,n=n)[para]
+
+    def get_many(self,times,paras,interp=None,n=slice(None)):
+        """
+        Dictionary of the values of each of paras at times[n], from one index lookup.
+        interp is 'previous' for the record for that second, or 'linear' 
+        to interpolate between records ( class default if None )
+        """
+        if(interp is None):
+            interp=self.interp
+        ind,lo,frac=self.align(times)
+        ans={}
+        if(interp=='linear'):
+            lo=lo[n]
+            frac=frac[n]
+            l=np.clip(lo,0,len(self.times)-1)
+            h=np.clip(lo+1,0,len(self.times)-1)
+            for para in paras:
+                d=self[para]
+                ans[para]=d[l]*(1-frac)+d[h]*frac
+        else:
+            ind=ind[n]
+            for para in paras:
+                d=self[para][np.clip(ind,0,len(self.times)-1)]
+                ans[para]=np.where(ind<0,np.nan,d)
+        return ans
+
+    def align(self,times):
+        """
+        Indexes into the data for times, and the lower index and fraction to 
+        interpolate. The last ones worked out are kept, so lookups at the same 
+        times ( usually the lidar Time ) don't need to search again
+        """
+        times=np.ma.filled(np.asarray(times,dtype=float),np.nan)
+        try:
+            t,ndata,ind,lo,frac=self._aligned
+            if(ndata==len(self.times) and np.array_equal(t,times)):
+                return ind,lo,frac
+        except AttributeError:
+            pass
         ind=self.get_indexes(times)
-        ind[ind>=len(self.data)]=len(self.data)-1
-        d=self.data[para][ind]
-        d[ind<0]=np.nan
-        return d
+        lo=np.searchsorted(self.times,times,side='right')-1
+        l=np.clip(lo,0,len(self.times)-1)
+        h=np.clip(lo+1,0,len(self.times)-1)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            frac=np.where(h>l,(times-self.times[l])/(self.times[h]-self.times[l]),0.0)
+        frac[(lo<0)|(times>self.times[-1])]=np.nan
+        self._aligned=(times.copy(),len(self.times),ind,lo,frac)
+        return ind,lo,frac
         
     def get_indexes(self,times):
         return np.digitize(times-1,self.times)
@@ -200,11 +287,222 @@ class aux_file(object):
         """
 
     def __getitem__(self,item):
-        return self.data[item]
+        return self._buffer[item]
 
     def write(self):
         np.savetxt(self.filename,self.data,fmt=self.format)
+        self.write_cache(self.data)
                 
     def read(self):
-        self.data=np.genfromtxt(self.filename,names=self.columns)
+        """
+        Read the text file, from the binary cache if that is up to date
+        """
+        d=self.read_cache()
+        if(d is None):
+            d=np.atleast_1d(np.genfromtxt(self.filename,names=self.columns))
+            self.write_cache(d)
+        self.data=d
+
+    @property
+    def cachename(self):
+        return os.path.splitext(self.filename)[0]+self.cache_suffix
+
+    @property
+    def cache_dtype(self):
+        return [(c,'<f8') for c in self.columns]
+
+    def cache_records(self):
+        """
+        Number of records in the binary cache, or None if it is missing or 
+        wasn't written for the text file as it is now ( size and mtime differ )
+        """
+        try:
+            st=os.stat(self.filename)
+            with open(self.cachename,'rb') as f:
+                magic,size,mtime,ncol=self.cache_header.unpack(f.read(self.cache_header.size))
+            nbytes=os.path.getsize(self.cachename)-self.cache_header.size
+        except(IOError,OSError,struct.error):
+            return None
+        if(magic!=self.cache_magic or size!=st.st_size or mtime!=st.st_mtime or ncol!=len(self.columns)):
+            return None
+        return nbytes//np.dtype(self.cache_dtype).itemsize
+
+    def read_cache(self):
+        """
+        Memory map the binary cache, None if it is out of date
+        """
+        n=self.cache_records()
+        if(n is None):
+            return None
+        if(n==0):
+            return np.empty(0,dtype=self.cache_dtype)
+        return np.memmap(self.cachename,dtype=self.cache_dtype,mode='r',
+                         offset=self.cache_header.size,shape=(n,))
+
+    def write_cache(self,data,append=False):
+        """
+        Write data to the binary cache, or add it to the end, and stamp it 
+        with the text file's size and mtime. Failing to is not an error, the 
+        text file is just read next time
+        """
+        try:
+            with open(self.cachename,'r+b' if append else 'wb') as f:
+                if(append):
+                    f.seek(0,2)
+                else:
+                    f.write(b'\0'*self.cache_header.size)
+                f.write(np.asarray(data,dtype=self.cache_dtype).tobytes())
+                st=os.stat(self.filename)
+                f.seek(0)
+                f.write(self.cache_header.pack(self.cache_magic,st.st_size,st.st_mtime,len(self.columns)))
+        except(IOError,OSError):
+            pass
+
+
+class http_transport(object):
+    """
+    Gets pages from a server over one kept open ( keep-alive ) HTTP connection,
+    reconnecting if it has been dropped. Any failure is raised as an IOError
+    """
+    def __init__(self,host,timeout=2):
+        self.host=host
+        self.timeout=timeout
+        self.connection=None
+
+    def get(self,path):
+        import httplib
+        import socket
+        for attempt in range(2):
+            try:
+                if(self.connection is None):
+                    self.connection=httplib.HTTPConnection(self.host,timeout=self.timeout)
+                self.connection.request('GET',path,headers={'Connection':'keep-alive'})
+                response=self.connection.getresponse()
+                body=response.read()
+                if(response.status!=200):
+                    raise IOError('HTTP {} from {}'.format(response.status,self.host))
+                return body
+            except(httplib.HTTPException,socket.error) as e:
+                self.close()
+                if(attempt):
+                    raise IOError(e)
+
+    def close(self):
+        if(self.connection is not None):
+            self.connection.close()
+            self.connection=None
+
+
+class aux_buffer(object):
+    """
+    Growable store for aux_file data. Records are appended into spare 
+    capacity, which is doubled when it runs out, so appending is cheap 
+    however long the flight. Readers get read only views of the records 
+    so far, which are safe to use while another thread appends.
+    The data given ( eg a memmap of the cache ) is used as it is, it is only 
+    copied into growable storage on the first append
+    """
+    def __init__(self,data,basetime,capacity=3600):
+        self.basetime=basetime
+        self.capacity=capacity
+        self.lock=threading.Lock()
+        self.growable=False
+        self._state=(data,data['Time']+basetime,len(data))
+
+    def append(self,data):
+        with self.lock:
+            d,t,n=self._state
+            need=n+len(data)
+            if(need>len(d) or not(self.growable)):
+                size=max(need,2*len(d),self.capacity)
+                d2=np.empty(size,dtype=d.dtype)
+                t2=np.empty(size)
+                d2[:n]=d[:n]
+                t2[:n]=t[:n]
+                d,t=d2,t2
+                self.growable=True
+            d[n:need]=data
+            t[n:need]=data['Time']+self.basetime
+            self._state=(d,t,need)
+
+    @property
+    def data(self):
+        d,t,n=self._state
+        v=d[:n]
+        v.setflags(write=False)
+        return v
+
+    @property
+    def times(self):
+        d,t,n=self._state
+        v=t[:n]
+        v.setflags(write=False)
+        return v
+
+    def __getitem__(self,item):
+        return self.data[item]
+
+    def __len__(self):
+        return self._state[2]
+
+
+class nc_buffer(object):
+    """
+    aux_file data from an open core netCDF. Only Time is read to start with,
+    each other column ( and its flag ) is read the first time it is asked for
+    """
+    def __init__(self,nc,columns,basetime,span=None,fill=np.nan):
+        self.nc=nc
+        self.columns=columns
+        self.fill=fill
+        self.lock=threading.Lock()
+        t=np.ma.getdata(nc.variables['Time'][:]).astype(float)
+        i0,i1=0,len(t)
+        if(span is not None):
+            # Keep a record either side so the ends can be interpolated
+            i0,i1=np.searchsorted(t+basetime,[span[0],span[1]])
+            i0,i1=max(i0-1,0),min(i1+1,len(t))
+        self.rows=slice(i0,i1)
+        self._columns={'Time':t[i0:i1]}
+        self._times=t[i0:i1]+basetime
+        self._times.setflags(write=False)
+
+    def __getitem__(self,item):
+        with self.lock:
+            if(item not in self._columns):
+                self._columns[item]=self.load(item)
+        return self._columns[item]
+
+    def load(self,c):
+        """
+        Read column c for the rows wanted, setting masked or flagged ( >1 ) values to fill
+        """
+        var=self.nc.variables[c]
+        index=(self.rows,0) if(len(var.shape)>1) else self.rows
+        d=var[index]
+        bad=np.ma.getmaskarray(d)
+        d=np.array(np.ma.getdata(d),dtype=float)
+        try:
+            bad|=np.ma.getdata(self.nc.variables[c+"_FLAG"][index])>1
+        except KeyError:
+            pass
+        d[bad]=self.fill
+        d.setflags(write=False)
+        return d
+
+    @property
+    def data(self):
+        d=np.empty(len(self),dtype=[(c,'f8') for c in self.columns])
+        for c in self.columns:
+            d[c]=self[c]
+        return d
+
+    @property
+    def times(self):
+        return self._times
+
+    def __len__(self):
+        return len(self._times)
 
+    def close(self):
+        self.nc.close()
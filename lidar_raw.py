@@ -5,84 +5,237 @@ import os.path
 import struct
 import glob
 import json
-import matplotlib.pyplot as plt
-import scipy.misc
+import logging
 from collections import OrderedDict
-from lidar_aux import aux_file
 import StringIO
+from zipfile import ZipFile
+
+log=logging.getLogger(__name__)
+
+class header_schema(object):
+    """
+    The header lines of the first raw file read and what they parsed to, 
+    with the types of each ( section, key )'s values. Lines of later files that are 
+    the same as in the first are not parsed again, and changed values
+    are converted to the types learnt
+    """
+    def __init__(self):
+        self.template={}
+        self.types={}
+
+    def learn(self,parsed):
+        """
+        Keep the lines of the first header with their ( key, value ) 
+        from a list of ( line, section, ( key, value ) )
+        """
+        if(not(self.template)):
+            for line,section,(k,d) in parsed:
+                if(k is not None):
+                    self.types[(section,k)]=[type(v) if type(v) in (int,float) else None for v in (d if type(d)==list else [d])]
+            self.template=dict([(line,kd) for line,section,kd in parsed])
+
+    def parse(self,line,section=''):
+        """
+        Key ( None if there isn't one ) and value of a header line in 
+        section, and whether it is the same as a line in the first file
+        """
+        if(line in self.template):
+            k,d=self.template[line]
+            if(type(d)==list):
+                d=list(d)           # Each header gets its own
+            return k,d,True
+        z=line.decode('latin1').replace(u'\xb0','deg').strip().split("=")
+        if(len(z)<2):
+            return None,z[0],False
+        d=z[1].split("\t")
+        types=self.types.get((section,z[0]),[])
+        if(len(types)!=len(d)):
+            types=[None]*len(d)
+        for j in range(len(d)):
+            d[j]=header_value(d[j],types[j])
+        if len(d)==1:
+            d=d[0]
+        return z[0],d,False
+
+def header_value(v,t=None):
+    """
+    Convert a header field to t ( int or float ), or if that isn't known 
+    or fails to int or float if possible
+    """
+    if(t is not None):
+        try:
+            return t(v)
+        except ValueError:
+            pass
+    try:
+        return int(v)
+    except ValueError:
+        try:
+            return float(v)
+        except ValueError:
+            return v
+
 
 class lidar_raw:
     """
     Class for reading in raw lidar files,
     and writing raw netcdf lidar data
+    If mmap is set the profiles of files on disk are memory mapped
+    ( read only ) rather than read in. schema is the header_schema to parse the header
+    against, shared between the files of a flight
     """
-    def __init__(self,filename,zipfile=None):
+    header_block=16384      # Bytes of header read at a time
+    def __init__(self,filename,zipfile=None,mmap=False,schema=None):
         self.filename=filename
+        if(schema is None):
+            schema=header_schema()
+        self.schema=schema
         if(zipfile):
-            self.file=StringIO.StringIO(zipfile.open(filename).read())
+            self.buffer=zipfile.read(filename)
+            self.file=StringIO.StringIO(self.buffer)
         else:
+            self.buffer=None
             self.file=open(filename,'rb')
-        self.header=OrderedDict()
         self.blind_smoothing=None
-        section=''
-        description=None
-        lines=0
-        headerlines=1000
-        while(lines<headerlines):
-            z=self.file.readline().decode('latin1').replace(u'\xb0','deg').strip().split("=")
-            lines+=1
-            if(len(z)>1):
-                d=z[1].split("\t")
-                for i in range(len(d)):
-                    try:
-                        d[i]=int(d[i])
-                    except ValueError:
-                        try:
-                            d[i]=float(d[i])
-                        except ValueError:
-                            pass
-                if len(d)==1:
-                    d=d[0]
-                if z[0]=="HeaderSize": headerlines=d
-                if z[0]==z[0].upper():
-                    if z[0]=="VARIABLES":
-                        self.header[section][z[0]]=d
-                        section="VARIABLES"
-                        self.header[section]=OrderedDict()
-                    else:
-                        section="ConfigSoftware"
-                        self.header[section][z[0]]=d
-                else:                  
-                    self.header[section][z[0]]=d
-            else:
-                if z[0].startswith('['):
-                    section=z[0][1:-1]
-                    self.header[section]=OrderedDict()
-                    if(description):
-                        self.header[section]["Description"]=description
-                        description=None
-                elif section=='':
-                    description=z[0] # Old flight !!
+        self.read_header()
         version=self.header['ConfigSoftware']['Version'].split('.')
         version=10000*float(version[0])+100*float(version[1])+float(version[2])
         try:
             self.pos=self.header['ConfigSoftware']['WritingPosition (byte)']
         except KeyError:
-            self.pos=self.file.tell()
+            self.pos=self.header_end
             #self.header['ConfigSoftware']['WritingPosition (byte)']=self.pos
             if(version>=11200):
-                print("Warning: Versions >= 1.12.0 should include Writing Position")
+                log.warning("Versions >= 1.12.0 should include Writing Position")
             else:
-                print("Info: Version < 1.12.0 ")
+                log.info("Version < 1.12.0 ")
             
             
         self.it = self.header['ConfigSoftware']['NumberOfShot'] / self.header['ConfigSoftware']['PRF (Hz)']
         self.nprof=self.header['ConfigSoftware']['NbOfProfilesPerFile'] 
         self.get_basetime()
         self.file.seek(self.pos)
-        (self.bdims,self.blindraw)=self.get_raw()
-        #pos=self.pos+8+self.bdims[0]*self.bdims[1]*4
-        #self.file.seek(pos)
+        if(not(mmap and not(zipfile) and self.map_profiles())):
+            self.file.seek(self.pos)
+            (self.bdims,self.blindraw)=self.get_raw()
+            #pos=self.pos+8+self.bdims[0]*self.bdims[1]*4
+            #self.file.seek(pos)
+            start=self.file.tell()
+            if(not(self.read_profiles())):
+                self.file.seek(start)
+                self.read_profiles_loop()
+        self.file.close()
+
+    def read_header(self):
+        """
+        Parse the header, up to HeaderSize lines, into self.header. The header
+        is read in blocks rather than line by line, and parsed against the 
+        schema learnt from the first file, so only lines which differ from 
+        that file are parsed again. Their values are also put in self.changes,
+        by section like self.header
+        """
+        self.header=OrderedDict()
+        self.changes=OrderedDict()
+        section=''
+        description=None
+        start=self.file.tell()
+        block=b''
+        pos=0
+        lines=0
+        headerlines=1000
+        parsed=[]
+        learning=not(self.schema.template)
+        while(lines<headerlines):
+            end=block.find(b'\n',pos)
+            if(end<0):
+                more=self.file.read(self.header_block)
+                if(more):
+                    block+=more
+                    continue
+                end=len(block)-1
+            line=block[pos:end+1]
+            pos=end+1
+            k,d,same=self.schema.parse(line,section)
+            parsed.append((line,section,(k,d)))
+            lines+=1
+            if(k is not None):
+                if k=="HeaderSize": headerlines=d
+                if k==k.upper() and k!="VARIABLES":
+                    section="ConfigSoftware"
+                self.header[section][k]=d
+                if(not(same or learning)):
+                    self.changes.setdefault(section,OrderedDict())[k]=d
+                if k=="VARIABLES":
+                    section="VARIABLES"
+                    self.header[section]=OrderedDict()
+            else:
+                if d.startswith('['):
+                    section=d[1:-1]
+                    self.header[section]=OrderedDict()
+                    if(description):
+                        self.header[section]["Description"]=description
+                        description=None
+                elif section=='':
+                    description=d # Old flight !!
+        self.header_end=start+pos
+        self.schema.learn(parsed)
+
+    def map_profiles(self):
+        """
+        Memory map the blind reference and the profiles from the file, 
+        so only the profiles actually used are read from disk.
+        Returns False if the file is too short for the fixed layout
+        """
+        self.bdims=self.get_dims()
+        start=self.pos+8+4*self.bdims[0]*self.bdims[1]
+        self.file.seek(start+8)
+        dims=self.get_dims()
+        dt=profile_dtype(dims)
+        if(os.path.getsize(self.filename)<start+self.nprof*dt.itemsize):
+            return False
+        self.blindraw=np.memmap(self.filename,dtype='>i4',mode='r',offset=self.pos+8,shape=self.bdims)
+        rec=np.memmap(self.filename,dtype=dt,mode='r',offset=start,shape=(self.nprof,))
+        self.dims=dims
+        self.times=decode_times(rec['time'])+self.basetime
+        self.raw=rec['raw']
+        return True
+
+    def read_profiles(self):
+        """
+        Decode all the profiles in one go, by viewing the data after the
+        blind reference as an array of fixed size records. The file is read
+        into a bytearray so self.raw is writable without copying it again.
+        Returns False if the records are not all the same size
+        """
+        if(self.buffer is None):
+            payload=bytearray(os.fstat(self.file.fileno()).st_size-self.file.tell())
+            size=self.file.readinto(payload)
+            offset=0
+        else:
+            payload=self.buffer
+            size=len(payload)
+            offset=self.file.tell()
+        if(size<offset+8+8):
+            return False
+        dims=struct.unpack('>II',bytes(payload[offset+8:offset+16]))
+        dt=profile_dtype(dims)
+        if(size<offset+self.nprof*dt.itemsize):
+            return False
+        rec=np.frombuffer(payload,dtype=dt,count=self.nprof,offset=offset)
+        if(np.any(rec['dims']!=dims)):
+            return False
+        self.dims=dims
+        self.times=decode_times(rec['time'])+self.basetime
+        self.raw=rec['raw']
+        if(self.buffer is not None):
+            self.raw=self.raw.copy()    # The zip buffer is read only
+        return True
+
+    def read_profiles_loop(self):
+        """
+        Decode profiles one at a time, for files where the 
+        profiles are not all the same size
+        """
         self.times=[self.get_time()]  
         (self.dims,raw)=self.get_raw()
         self.raw=np.empty((self.nprof,)+self.dims,dtype=raw.dtype)
@@ -94,7 +247,16 @@ class lidar_raw:
                 self.times.append(self.get_time())
                 (self.dims,raw)=self.get_raw()
                 self.raw[n]=raw
-        self.file.close()
+
+    def __getstate__(self):
+        """
+        Leave out the (closed) file and buffer when pickling, 
+        so decoded files can be passed back from worker processes
+        """
+        state=self.__dict__.copy()
+        state.pop('file',None)
+        state['buffer']=None
+        return state
 
     def get_time(self):
         t=self.file.read(8)
@@ -105,10 +267,10 @@ class lidar_raw:
 
     def get_raw(self):
         dims=self.get_dims()
-        try:
+        if(self.buffer is None):
             data=np.fromfile(self.file,count=dims[0]*dims[1],dtype='>i4').reshape(dims)
-        except IOError:
-            data=np.frombuffer(self.file.getvalue()[self.file.tell():],count=dims[0]*dims[1],dtype='>i4').reshape(dims)
+        else:
+            data=np.frombuffer(self.buffer,count=dims[0]*dims[1],dtype='>i4',offset=self.file.tell()).reshape(dims)
             self.file.seek(dims[0]*dims[1]*4,1)
         return dims,data
 
@@ -119,42 +281,47 @@ class lidar_raw:
     def get_basetime(self):
         self.basetime=time.mktime(time.strptime(self.header['ConfigSoftware']['DateRun']+"-UTC","%Y-%m-%d-%Z"))
 
-    def createrawNetCDF(self,filename='',fltno='XXXX',revision=0,**kwargs):
+    def createrawNetCDF(self,filename='',fltno='XXXX',revision=0,chunk=16,complevel=4,shuffle=True,layout=('Range','Time'),**kwargs):
         if(not(filename) or os.path.isdir(filename)):
             fn=('metoffice-lidar_faam_'+self.getdate()+'_r%1.1i_'+fltno+'_raw.nc') % revision
             filename=os.path.join(filename,fn)
-        print(filename)
-        return filename,self.openrawNetCDF(Dataset(filename,"w",clobber=True))
+        log.debug('Creating %s',filename)
+        return filename,self.openrawNetCDF(Dataset(filename,"w",clobber=True),chunk=chunk,complevel=complevel,shuffle=shuffle,layout=layout)
 
-    def openrawNetCDF(self,nc):
+    def openrawNetCDF(self,nc,chunk=16,complevel=4,shuffle=True,layout=('Range','Time')):
         """ Opens a raw netcdf file and creates 
         variables and attibutes.
         The global attributes are based on the "ConfigSoftware" header info
         The variables are from InfoBlindRef and infoRaw as well
         as the raw signal, photon count and blind reference values
+        The raw data is chunked as the full range by chunk profiles, 
+        if chunk is None the netCDF library default is used.
+        layout is ('Range','Time') or ('Time','Range') for the raw data,
+        ('Time','Range') keeps each profile contiguous on disk
         """
         for att in self.header["ConfigSoftware"]:
             nc.setncattr(att,self.header["ConfigSoftware"][att])
         nc.createDimension('Time',None)
         nc.createDimension('Range',self.dims[1])
-        t=nc.createVariable('Time',float,('Time'))
+        tchunks=None
+        rawchunks=None
+        if(chunk):
+            tchunks=(max(chunk,512),)
+            rawchunks=(self.dims[1],chunk)
+            if(layout[0]=='Time'):
+                rawchunks=(chunk,self.dims[1])
+        t=nc.createVariable('Time',float,('Time'),chunksizes=tchunks)
         t.setncattr("units","seconds since 1970-01-01 00:00:00 +0000")
         t.setncattr("long_name","time of measurement")
         t.setncattr("standard_name","time")
         
         for sect,prefix in [("InfoBlindRef","Blind_"),("infoRaw","Raw_"),("VARIABLES","")]:
             for att in self.header[sect]:
-                nc.createVariable(prefix+att,float,('Time'))
+                nc.createVariable(prefix+att,float,('Time'),chunksizes=tchunks)
         
-        for i in range(2):
-            nc.createVariable('rawSignal_%1.1i' % i,'i4',('Range','Time'),zlib=True)
-
-        for i in range(2,self.dims[0]):
-            nc.createVariable('rawPhoton_%1.1i' % (i-2),'i4',('Range','Time'),zlib=True)
-
-
-        for i in range(self.bdims[0]):
-            nc.createVariable('rawBlind_%1.1i' % i,'i4',('Range','Time'),zlib=True)
+        for var,i in raw_variables(self.dims)+blind_variables(self.bdims):
+            nc.createVariable(var,'i4',tuple(layout),zlib=(complevel>0),complevel=complevel,
+                              shuffle=shuffle,chunksizes=rawchunks)
 
         return nc    
         
@@ -163,43 +330,102 @@ class lidar_raw:
         """
         Add data to a netcdf file
         """
-        n=len(nc.variables['Time'])
-        n2=n+len(self.times)
-        nc.variables['Time'][n:]=self.times
-        for i in range(2):
-            nc.variables['rawSignal_%1.1i' % i][:,n:]=self.raw.T[:,i,:]
+        add_files(nc,[self])
+            
+
+class raw_writer(object):
+    """
+    Buffers decoded raw files and writes them to a netcdf file
+    nfiles at a time, so each variable gets one larger write 
+    """
+    def __init__(self,nc,nfiles=8):
+        self.nc=nc
+        self.nfiles=nfiles
+        self.pending=[]
+
+    def add(self,l):
+        self.pending.append(l)
+        if(len(self.pending)>=self.nfiles):
+            self.flush()
 
-        for i in range(2,self.dims[0]):
-            nc.variables['rawPhoton_%1.1i' % (i-2)][:,n:]=self.raw.T[:,i,:]
+    def flush(self):
+        if(self.pending):
+            add_files(self.nc,self.pending)
+            self.pending=[]
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.flush()
+
+def raw_variables(dims):
+    """
+    Names and indexes of the signal and photon counting variables
+    """
+    return [('rawSignal_%1.1i' % i,i) for i in range(2)]+[('rawPhoton_%1.1i' % (i-2),i) for i in range(2,dims[0])]
+
+def blind_variables(bdims):
+    """
+    Names and indexes of the blind reference variables
+    """
+    return [('rawBlind_%1.1i' % i,i) for i in range(bdims[0])]
+
+def profile_major(var):
+    """
+    True if a raw variable is stored as ('Time','Range')
+    """
+    return var.dimensions[0]=='Time'
+
+def read_profiles(var,n,gates=slice(None)):
+    """
+    Read profile(s) n, range gates gates only, from a raw 
+    variable in either layout, returned as ( Range, ... ) 
+    """
+    if(profile_major(var)):
+        return var[n,gates].T
+    return var[gates,n]
+
+def add_files(nc,raws):
+    """
+    Add the data from a list of lidar_raw objects to a netcdf file,
+    the profiles are written with one write per variable
+    """
+    n=len(nc.variables['Time'])
+    starts=np.cumsum([n]+[len(l.times) for l in raws])
+    nc.variables['Time'][n:]=np.concatenate([np.asarray(l.times,dtype=float) for l in raws])
+    raw=np.concatenate([l.raw for l in raws])
+    for var,i in raw_variables(raws[0].dims):
+        if(profile_major(nc.variables[var])):
+            nc.variables[var][n:,:]=raw[:,i,:]
+        else:
+            nc.variables[var][:,n:]=raw[:,i,:].T
+
+    for l,start in zip(raws,starts):
         """
         #Fill all blind refs
-        for i in range(self.bdims[0]):
-            for nn in range(n,n2):
-                nc.variables['rawBlind_%1.1i' % i][:,nn]=self.blindraw[i]
+        for i in range(l.bdims[0]):
+            for nn in range(start,start+len(l.times)):
+                nc.variables['rawBlind_%1.1i' % i][:,nn]=l.blindraw[i]
         """
         #fill only relavent blindrefs up
-        for i in range(self.bdims[0]):
-            nc.variables['rawBlind_%1.1i' % i][:,n]=self.blindraw[i]
-        
+        for var,i in blind_variables(l.bdims):
+            if(profile_major(nc.variables[var])):
+                nc.variables[var][start,:]=l.blindraw[i]
+            else:
+                nc.variables[var][:,start]=l.blindraw[i]
         
         for sect,prefix in [("InfoBlindRef","Blind_"),("infoRaw","Raw_"),("VARIABLES","")]:
-            for att in self.header[sect]:
+            for att in l.header[sect]:
                 try:
-                    if(len(self.header[sect][att])>1):
-                        nc.variables[prefix+att][n:]=self.header[sect][att]
+                    if(len(l.header[sect][att])>1):
+                        nc.variables[prefix+att][start:start+len(l.times)]=l.header[sect][att]
                     else:
-                        nc.variables[prefix+att][n]=self.header[sect][att]
+                        nc.variables[prefix+att][start]=l.header[sect][att]
                 except TypeError:       
-                    nc.variables[prefix+att][n]=self.header[sect][att]
-            
+                    nc.variables[prefix+att][start]=l.header[sect][att]
 
-def rebuild_raw(ncdata,folder=''):
-    """
-    Function to write lidar data as
-    leosphere style raw files
-    """
-    formats={'Altitude (m)':'{:.6f}','Longitude (deg)':'{:.6f}','Latitude (deg)':'{:.6f}',
+raw_formats={'Altitude (m)':'{:.6f}','Longitude (deg)':'{:.6f}','Latitude (deg)':'{:.6f}',
              'Pressure (hPa)':'{:.1f}','Temperature (degC)':'{:.1f}','Humidity (%)':'{:.1f}',
              'AngleAzimuth':'{:.1f}','AngleZenith':'{:.1f}','AnglesNB AA':'{:.0f}',
              'AnglesNB ZA':'{:.0f}','NumberOfShot':'{:.0f}','Wave length (nm)':'{:.0f}',
@@ -207,76 +433,241 @@ def rebuild_raw(ncdata,folder=''):
              'DecimalSeparator':'{:.0f}','NbOfProfilesPerFile':'{:.0f}','DataCodage':'{:.0f}',
              'WritingPosition (byte)':'{:.0f}','NumberOfSignal':'{:.0f}',
              'HeaderSize':'{:.0f}','ID ALS':'{:.0f}'}
-    t=ncdata['Time'][:]
-    basetime=86400*(t[0]//86400)
-    nprof=ncdata.getncattr('NbOfProfilesPerFile')
-    variables=[u'Altitude (m)', u'Longitude (deg)', u'Latitude (deg)', u'Pressure (hPa)', u'Temperature (degC)', u'AngleAzimuth', u'AngleZenith']
-    for start,stop in ncdata.get_raw_indexes():
-        filename=time.strftime("_%Y-%m-%d_%H-%M-%S",time.gmtime(t[start]))+time.strftime("_%H-%M-%S.raw",time.gmtime(t[stop-1]))
-        filename=os.path.join(folder,filename)
-        with open(filename,"wb") as f:
-            try:
-                nwrite=ncdata.getncattr("WritingPosition (byte)")
-            except AttributeError:
-                nwrite=-1
-            f.write("[ConfigSoftware]\r\n")
-            for att in ncdata.ncattrs():
-                line=att+"="
-                try:
-                    form=formats[att]
-                except KeyError:
-                    form="{:.9f}"
-                data=ncdata.getncattr(att)
-                if(att=='NbOfProfilesPerFile'):
-                    data=(stop-start)
-                if(att=='DateRun'):
-                    data=time.strftime('%Y-%m-%d',time.gmtime(t[start]))
-                if(str(data)==data):
-                    line+=str(data)
-                else:
-                    try:
-                        line+="\t".join([form.format(d) for d in data])
-                    except TypeError:
-                        line+=form.format(data)
-                line+="\r\n"
-                line=(line.replace('deg',u'\xb0')).encode("latin-1")
-                f.write(line)
-                if(att=="VARIABLES"):
-                    for v in variables:
-                        if(v in formats):
-                            form=formats[v].replace("{:","%").replace("}","")
-                        else:
-                            form="%.9f"
-                        f.write((v.replace('deg',u'\xb0')).encode("latin-1")+"=")
-                        try:
-                            ncdata.variables[v][start:stop].tofile(f,sep="\t",format=form)
-                        except NotImplementedError:
-                            ncdata.variables[v][start].tofile(f,sep="\t",format=form)
-                        f.write("\r\n")
-                    
-            for sect,prefix in [("InfoBlindRef","Blind_"),("infoRaw","Raw_")]:
-                f.write("["+sect+"]\r\n")
-                for v in ncdata.variables:
-                    if(v.startswith(prefix)):
-                        line=v.replace(prefix,"")
-                        if(line in formats):
-                            form=formats[line]
-                        else:
-                            form="{:.9f}"
-                        line+="="+form.format(ncdata.variables[v][start])+"\r\n"
-                        f.write(line)
-            if(nwrite>0):
-                f.seek(nwrite)
-            dim1=ncdata.variables['rawSignal_0'].shape[0]
-            f.write(write_dims((2,dim1)))
-            ncdata.variables['rawBlind_0'][:,start].astype(">i4").tofile(f,"")
-            ncdata.variables['rawBlind_1'][:,start].astype(">i4").tofile(f,"")
-            for tx in range(start,stop):
-                f.write(write_time(t[tx]))
-                f.write(write_dims((4,dim1)))
-                for var in ['rawSignal_0','rawSignal_1','rawPhoton_0','rawPhoton_1']:
-                    ncdata.variables[var][:,tx].astype(">i4").tofile(f,"")
+header_variables=[u'Altitude (m)', u'Longitude (deg)', u'Latitude (deg)', u'Pressure (hPa)', u'Temperature (degC)', u'AngleAzimuth', u'AngleZenith']
+signal_variables=['rawSignal_0','rawSignal_1','rawPhoton_0','rawPhoton_1']
+
+def rebuild_raw(ncdata,folder='',workers=1):
+    """
+    Function to write lidar data as
+    leosphere style raw files. With workers>1 the 
+    files are written by a pool of processes reading the netCDF file
+    """
+    header=raw_header(ncdata)
+    indexes=list(ncdata.get_raw_indexes())
+    if(workers<=1):
+        for start,stop in indexes:
+            write_raw_file(ncdata,folder,header,start,stop)
+        return
+    try:
+        ncdata.data.sync()
+    except RuntimeError:
+        pass        # Read only
+    tasks=[(ncdata.data.filepath(),folder,header,start,stop) for start,stop in indexes]
+    import multiprocessing
+    pool=multiprocessing.Pool(workers)
+    try:
+        pool.map(_write_raw_file,tasks)
+    finally:
+        pool.terminate()
+        pool.join()
+
+_raw_datasets={}
+
+def _write_raw_file(args):
+    path,folder,header,start,stop=args
+    if(path not in _raw_datasets):
+        os.environ.setdefault('HDF5_USE_FILE_LOCKING','FALSE')
+        _raw_datasets[path]=Dataset(path)
+    write_raw_file(_raw_datasets[path],folder,header,start,stop)
+
+def raw_header(ncdata):
+    """
+    The parts of the raw file header that are the same for every file, as 
+    ( attribute lines, [ ( section, prefix, variables ) ], writing position ).
+    Attributes that change from file to file have None for their line
+    """
+    lines=[]
+    for att in ncdata.ncattrs():
+        if(att in ['NbOfProfilesPerFile','DateRun']):
+            lines.append((att,None))
+        else:
+            lines.append((att,header_line(att,ncdata.getncattr(att))))
+    sections=[]
+    for sect,prefix in [("InfoBlindRef","Blind_"),("infoRaw","Raw_")]:
+        sections.append((sect,prefix,[v for v in ncdata.variables if v.startswith(prefix)]))
+    try:
+        nwrite=ncdata.getncattr("WritingPosition (byte)")
+    except AttributeError:
+        nwrite=-1
+    return lines,sections,nwrite
 
+def header_line(att,data):
+    """
+    "att=value" line of a raw file header, encoded for writing
+    """
+    form=raw_formats.get(att,"{:.9f}")
+    line=att+"="
+    if(str(data)==data):
+        line+=str(data)
+    else:
+        try:
+            line+="\t".join([form.format(d) for d in data])
+        except TypeError:
+            line+=form.format(data)
+    line+="\r\n"
+    return (line.replace('deg',u'\xb0')).encode("latin-1")
+
+def write_raw_file(ncdata,folder,header,start,stop):
+    """
+    Write profiles start:stop as one raw file, header is from raw_header. 
+    Each variable is read once for the whole file, and the profiles
+    are put together in one big endian buffer and written in one go
+    """
+    lines,sections,nwrite=header
+    t=ncdata['Time'][start:stop]
+    filename=time.strftime("_%Y-%m-%d_%H-%M-%S",time.gmtime(t[0]))+time.strftime("_%H-%M-%S.raw",time.gmtime(t[-1]))
+    filename=os.path.join(folder,filename)
+    text=[b"[ConfigSoftware]\r\n"]
+    for att,line in lines:
+        if(att=='NbOfProfilesPerFile'):
+            line=header_line(att,stop-start)
+        if(att=='DateRun'):
+            line=header_line(att,time.strftime('%Y-%m-%d',time.gmtime(t[0])))
+        text.append(line)
+        if(att=="VARIABLES"):
+            for v in header_variables:
+                form=raw_formats.get(v,"{:.9f}").replace("{:","%").replace("}","")
+                values=np.atleast_1d(np.ma.getdata(ncdata.variables[v][start:stop]))
+                text.append((v+u"="+u"\t".join([form % d for d in values])+u"\r\n").replace('deg',u'\xb0').encode("latin-1"))
+    for sect,prefix,names in sections:
+        text.append(("["+sect+"]\r\n").encode("latin-1"))
+        for v in names:
+            text.append(header_line(v.replace(prefix,""),ncdata.variables[v][start]))
+    body=raw_body(ncdata,t,start,stop)
+    with open(filename,"wb") as f:
+        f.write(b"".join(text))
+        if(nwrite>0):
+            f.seek(nwrite)
+        body.tofile(f)
+
+def raw_body(ncdata,t,start,stop):
+    """
+    The binary part of a raw file for profiles start:stop as one 
+    structured big endian record: dimensions and blind 
+    references followed by the profile records
+    """
+    dim1=len(ncdata.dimensions['Range'])
+    body=np.empty((),dtype=[('dims','>u4',(2,)),('blind','>i4',(2,dim1)),
+                            ('profiles',profile_dtype((4,dim1)),(stop-start,))])
+    body['dims']=(2,dim1)
+    body['blind'][0]=read_profiles(ncdata.variables['rawBlind_0'],start)
+    body['blind'][1]=read_profiles(ncdata.variables['rawBlind_1'],start)
+    profiles=body['profiles']
+    profiles['time']=encode_times(t)
+    profiles['dims']=(4,dim1)
+    for i,var in enumerate(signal_variables):
+        profiles['raw'][:,i]=read_profiles(ncdata.variables[var],slice(start,stop)).T
+    return body
+
+
+def read_raw(filename,zipname=None,schema=None):
+    """
+    Read a raw file, the zip file ( if any ) is given by name
+    so this can be used from worker processes
+    """
+    if(zipname):
+        return lidar_raw(filename,zipfile=ZipFile(zipname),schema=schema)
+    return lidar_raw(filename,schema=schema)
+
+def _read_raw(args):
+    return read_raw(*args)
+
+def read_raw_files(files,zipfile=None,workers=1,chunksize=1,schema=None):
+    """
+    Generator of lidar_raw objects for the files, in order.
+    If workers>1 the files are decoded in a pool of worker processes
+    while the caller writes out the earlier ones. The headers are parsed
+    against schema, or one learnt from the first of the files
+    """
+    if(schema is None):
+        schema=header_schema()
+    if(workers<=1):
+        for f in files:
+            yield lidar_raw(f,zipfile=zipfile,schema=schema)
+        return
+    files=list(files)
+    if(files and not(schema.template)):
+        yield lidar_raw(files[0],zipfile=zipfile,schema=schema)    # Learn the schema before the workers get it
+        files=files[1:]
+    zipname=None
+    if(zipfile):
+        zipname=zipfile.filename
+    import multiprocessing
+    pool=multiprocessing.Pool(workers)
+    try:
+        for l in pool.imap(_read_raw,[(f,zipname,schema) for f in files],chunksize):
+            yield l
+    finally:
+        pool.terminate()
+        pool.join()
+
+def raw_time(filename):
+    """
+    Start time of a raw file from its name
+    """
+    return time.mktime(time.strptime(filename[-32:-13]+"-UTC","%Y-%m-%d_%H-%M-%S-%Z"))
+
+class raw_watcher(object):
+    """
+    Watches a folder for raw files newer than a high water mark ( last ).
+    Each file name is only looked at once, and new files are only
+    returned once their size has stopped changing between polls
+    """
+    def __init__(self,folder,last=0):
+        self.folder=folder
+        self.last=last
+        self.done=set()
+        self.sizes={}
+
+    def poll(self):
+        """
+        List of new, complete raw files ( oldest first ), 
+        the high water mark is moved on past them
+        """
+        new=[]
+        for f in sorted(os.listdir(self.folder)):
+            if(f in self.done or not(f.endswith('.raw'))):
+                continue
+            if(raw_time(f)<=self.last):
+                self.done.add(f)
+                continue
+            size=os.path.getsize(os.path.join(self.folder,f))
+            if(self.sizes.get(f)==size):
+                new.append(f)
+                self.done.add(f)
+                del self.sizes[f]
+            else:
+                self.sizes[f]=size
+        if(new):
+            self.last=raw_time(new[-1])
+        return [os.path.join(self.folder,f) for f in new]
+
+def profile_dtype(dims):
+    """
+    Numpy dtype of a single profile record in a raw file,
+    time string (HH-MM-SS), dimensions and then the signals
+    """
+    return np.dtype([('time','S8'),('dims','>u4',(2,)),('raw','>i4',tuple(dims))])
+
+def decode_times(t):
+    """
+    Convert an array of HH-MM-SS time strings into seconds since midnight
+    """
+    c=np.frombuffer(np.ascontiguousarray(t).tobytes(),dtype='u1').reshape(-1,8).astype(int)-48
+    return (c[:,0]*10+c[:,1])*3600.0+(c[:,3]*10+c[:,4])*60+c[:,6]*10+c[:,7]
+
+def encode_times(t):
+    """
+    Convert times ( seconds ) into an array of HH-MM-SS time strings, 
+    the reverse of decode_times
+    """
+    s=np.floor(np.asarray(t,dtype=float)).astype(int)%86400
+    c=np.empty((len(s),8),dtype='u1')
+    c[:]=ord('-')
+    for i,v in [(0,s//3600),(3,(s//60)%60),(6,s%60)]:
+        c[:,i]=v//10+48
+        c[:,i+1]=v%10+48
+    return c.view('S8')[:,0]
 
 def write_dims(dims):
     return struct.pack('>II',*dims) 